@@ -1,1183 +1,5517 @@
 from rauth import OAuth1Session, OAuth1Service
-import xml.etree.ElementTree as ET
+try:
+    # the C implementation parses (and iterparses) several times faster
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
 import xmltodict
+from xml.parsers.expat import ExpatError
 import requests
-import json, time
+import json, time, re, random
+import threading, Queue
+import sqlite3
+import codecs
+import collections, copy
+import os, hashlib, mimetypes, uuid, tempfile
+
+try:
+    # a much faster (C) encoder/decoder, if it's installed
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    # only needed for ColumnarExporter
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    # only needed for LedgerEngine
+    import numpy
+except ImportError:
+    numpy = None
+
+import datetime
+
+def run_in_pool(func, args_list, max_workers=4):
+    """
+    Calls func(*args) for every args tuple in args_list on a bounded pool
+    of worker threads, and returns the results in the same order as
+    args_list (so callers can stitch pages etc. back together).
+
+    If any call raises, the first exception (in args_list order) is
+    re-raised once all the workers have finished.
+    """
+
+    results = [None] * len(args_list)
+    errors  = [None] * len(args_list)
+
+    if len(args_list) == 0:
+        return results
 
-class QuickBooks():
-    """A wrapper class around Python's Rauth module for Quickbooks the API"""
+    jobs = Queue.Queue()
 
-    access_token = ''
-    access_token_secret = ''
-    consumer_key = ''
-    consumer_secret = ''
-    company_id = 0
-    callback_url = ''
-    session = None
+    for i, args in enumerate(args_list):
+        jobs.put((i, args))
 
-    base_url_v3 =  "https://quickbooks.api.intuit.com/v3"
-    base_url_v2 = "https://qbo.intuit.com/qbo1"
+    def worker():
+        while True:
+            try:
+                i, args = jobs.get_nowait()
+            except Queue.Empty:
+                return
 
-    request_token_url = "https://oauth.intuit.com/oauth/v1/get_request_token"
-    access_token_url = "https://oauth.intuit.com/oauth/v1/get_access_token"
+            try:
+                results[i] = func(*args)
+            except Exception as e:
+                errors[i] = e
 
-    authorize_url = "https://appcenter.intuit.com/Connect/Begin"
+    threads = []
 
-    # Things needed for authentication
-    qbService = None
+    for n in range(min(max_workers, len(args_list))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
 
-    request_token = ''
-    request_token_secret = ''
+    for t in threads:
+        t.join()
 
-    def __init__(self, **args):
+    for e in errors:
+        if e is not None:
+            raise e
 
-        if 'cred_path' in args:
-            self.read_creds_from_file(args['cred_path'])
+    return results
 
-        if 'consumer_key' in args:
-            self.consumer_key = args['consumer_key']
+class JsonCodec():
+    """
+    How request bodies get encoded and response bodies decoded. Uses ujson
+    when it's available and the stdlib json module otherwise; either way
+    the encoded bodies are compact (no indentation or spaces).
 
-        if 'consumer_secret' in args:
-            self.consumer_secret = args['consumer_secret']
+    Anything with the same encode/decode methods can be used instead, by
+    setting QuickBooks.codec.
+    """
 
-        if 'access_token' in args:
-            self.access_token = args['access_token']
+    def __init__(self, use_fast = True):
+        self.fast = ujson if use_fast else None
 
-        if 'access_token_secret' in args:
-            self.access_token_secret = args['access_token_secret']
+    def encode(self, obj):
+        if self.fast is not None:
+            #ujson's defaults round floats to 10 digits and escape "/"
+            try:
+                return self.fast.dumps(obj, double_precision = 15,
+                                       escape_forward_slashes = False)
+            except TypeError:
+                #a ujson too old for those options (or something it can't
+                #encode, which json will say so about)
+                pass
+
+        return json.dumps(obj, separators=(",", ":"))
+
+    def decode(self, text):
+        if self.fast is not None:
+            return self.fast.loads(text)
+
+        return json.loads(text)
+
+default_codec = JsonCodec()
+
+def iter_json_array(chunks, key, container = "QueryResponse"):
+    """
+    Incrementally decodes the {container: {key: [...]}} array of a JSON
+    body arriving as byte chunks (e.g. response.iter_content()), yielding
+    each element as soon as it's complete. Only one element (plus one chunk)
+    is ever held in memory.
+
+    If the body turns out not to have that array, it's decoded whole
+    instead: an empty container just ends the generator, anything else
+    (a Fault, say) raises an Exception carrying the decoded body.
+
+    This always decodes with the stdlib json module, whatever codec the
+    client has, since it needs raw_decode (which ujson doesn't have) to
+    pick elements out of a partial buffer.
+    """
+
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    start = re.compile(r'"%s"\s*:\s*\{.*?"%s"\s*:\s*\[' % (container, key),
+                       re.DOTALL)
+    whitespace = re.compile(r"[\s,]*")
+
+    chunks = iter(chunks)
+    buffer = u""
+    exhausted = False
+
+    def more():
+        try:
+            return text_decoder.decode(next(chunks))
+        except StopIteration:
+            return None
 
-        if 'company_id' in args:
-            self.company_id = args['company_id']
+    #find the opening bracket of the array
+    while True:
+        match = start.search(buffer)
 
-        if 'callback_url' in args:
-            self.callback_url = args['callback_url']
+        if match is not None:
+            break
 
-        if 'verbose' in args:
-            self.verbose = True
-        else:
-            self.verbose = False
+        chunk = more()
 
-        if 'verbosity' in args:
-            self.verbosity = args['verbosity']
-        else:
-            self.verbosity = 0
+        if chunk is None:
+            body = json.loads(buffer) if buffer.strip() else {}
 
-        self._BUSINESS_OBJECTS = [
+            if container in body and "Fault" not in body:
+                #a query with no results
+                return
 
-            "Account","Attachable","Bill","BillPayment",
-            "Class","CompanyInfo","CreditMemo","Customer",
-            "Department","Employee","Estimate","Invoice",
-            "Item","JournalEntry","Payment","PaymentMethod",
-            "Preferences","Purchase","PurchaseOrder",
-            "SalesReceipt","TaxCode","TaxRate","Term",
-            "TimeActivity","Vendor","VendorCredit"
+            raise Exception("No %s.%s array in the response: %s" % \
+                            (container, key, body))
 
-        ]
+        buffer += chunk
 
-        self._NAME_LIST_OBJECTS = [
+    buffer = buffer[match.end():]
 
-            "Account", "Class", "Customer", "Department", "Employee", "Item",
-            "PaymentMethod", "TaxCode", "TaxRate", "Term", "Vendor"
+    #then decode it one element at a time
+    while True:
+        position = whitespace.match(buffer).end()
 
-        ]
+        if position < len(buffer) and buffer[position] == "]":
+            return
 
-        self._TRANSACTION_OBJECTS = [
+        if position < len(buffer):
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                element = None
 
-            "Bill", "BillPayment", "CreditMemo", "Estimate", "Invoice",
-            "JournalEntry", "Payment", "Purchase", "PurchaseOrder",
-            "SalesReceipt", "TimeActivity", "VendorCredit"
+            if element is not None and (end < len(buffer) or exhausted):
+                buffer = buffer[end:]
+                yield element
+                continue
 
-        ]
+        if exhausted:
+            raise Exception("The response ended in the middle of %s." % key)
 
+        chunk = more()
 
-    def get_authorize_url(self):
-        """Returns the Authorize URL as returned by QB,
-        and specified by OAuth 1.0a.
-        :return URI:
-        """
-        self.qbService = OAuth1Service(
-                name = None,
-                consumer_key = self.consumer_key,
-                consumer_secret = self.consumer_secret,
-                request_token_url = self.request_token_url,
-                access_token_url = self.access_token_url,
-                authorize_url = self.authorize_url,
-                base_url = None
-            )
+        if chunk is None:
+            exhausted = True
+        else:
+            buffer += chunk
 
-        rt, rts = self.qbService.get_request_token(
-            params={'oauth_callback':self.callback_url}
-        )
+class Future():
+    """
+    The eventual result of a call running on a WorkerPool. result() blocks
+    until it's ready (and re-raises whatever the call raised).
+    """
 
-        self.request_token, self.request_token_secret = [rt, rts]
+    def __init__(self):
 
-        return self.qbService.get_authorize_url(self.request_token)
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.value = None
+        self.error = None
+        self.callbacks = []
 
-    def get_access_tokens(self, oauth_verifier):
-        """Wrapper around get_auth_session, returns session, and sets
-        access_token and access_token_secret on the QB Object.
-        :param oauth_verifier: the oauth_verifier as specified by OAuth 1.0a
-        """
-        session = self.qbService.get_auth_session(
-                self.request_token,
-                self.request_token_secret,
-                data={'oauth_verifier': oauth_verifier})
+    def set_result(self, value):
+        self.value = value
+        self.finish()
 
-        self.access_token = session.access_token
-        self.access_token_secret = session.access_token_secret
+    def set_exception(self, error):
+        self.error = error
+        self.finish()
 
-        return session
+    def finish(self):
 
-    def create_session(self):
-        if self.consumer_secret and self.consumer_key and \
-           self.access_token_secret and self.access_token:
-            self.session = OAuth1Session(self.consumer_key,
-                                         self.consumer_secret,
-                                         self.access_token,
-                                         self.access_token_secret)
+        with self.lock:
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
 
-        else:
+        for callback in callbacks:
+            callback(self)
 
-            # shouldn't there be a workflow somewhere to GET the auth tokens?
+    def done(self):
+        return self.event.is_set()
 
-            # add that or ask someone on oDesk to build it...
+    def result(self, timeout = None):
 
-            raise Exception("Need four creds for Quickbooks.create_session.")
+        if not self.event.wait(timeout):
+            raise Exception("Timed out waiting for the result.")
 
-        return self.session
+        if self.error is not None:
+            raise self.error
 
-    def query_fetch_more(self, r_type, header_auth, realm,
-                         qb_object, original_payload =''):
-        """ Wrapper script around keep_trying to fetch more results if
-        there are more. """
+        return self.value
 
-        # 500 is the maximum number of results returned by QB
+    def exception(self, timeout = None):
 
-        max_results = 500
-        start_position = 0
-        more = True
-        data_set = []
-        url = self.base_url_v3 + "/company/%s/query" % self.company_id
+        if not self.event.wait(timeout):
+            raise Exception("Timed out waiting for the result.")
 
-        # Edit the payload to return more results.
+        return self.error
 
-        payload = original_payload + " MAXRESULTS " + str(max_results)
+    def add_done_callback(self, callback):
+        """Calls callback(future) once it's done (right away if it is)."""
 
-        while more:
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
 
-            r_dict = self.keep_trying(r_type, url, True, self.company_id, payload)
+        callback(self)
 
-            try:
-                access = r_dict['QueryResponse'][qb_object]
-            except:
-                if 'QueryResponse' in r_dict and r_dict['QueryResponse'] == {}:
-                    #print "Query OK, no results: %s" % r_dict['QueryResponse']
-                    return []
-                else:
-                    print "FAILED", r_dict
-                    r_dict = self.keep_trying(r_type,
-                                              url,
-                                              True,
-                                              self.company_id,
-                                              payload)
+class WorkerPool():
+    """
+    A fixed set of long-lived worker threads that run submitted calls and
+    hand back Futures. Unlike run_in_pool it can be shared (e.g. by several
+    AsyncQuickBooks clients) and fed continuously.
+    """
 
-            # For some reason the totalCount isn't returned for some queries,
-            # in that case, check the length, even though that actually requires
-            # measuring
-            try:
-                result_count = int(r_dict['QueryResponse']['totalCount'])
-                if result_count < max_results:
-                    more = False
-            except KeyError:
-                try:
-                    result_count = len(r_dict['QueryResponse'][qb_object])
-                    if result_count < max_results:
-                        more = False
-                except KeyError:
-                    print "\n\n ERROR", r_dict
-                    pass
+    def __init__(self, max_workers = 8):
 
+        self.max_workers = max_workers
+        self.jobs = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
 
-            if self.verbose:
+    def start(self):
 
-                print "(batch begins with record %d)" % start_position
+        with self.lock:
+            while len(self.threads) < self.max_workers:
+                t = threading.Thread(target=self.work)
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
 
+    def work(self):
 
-            # Just some math to prepare for the next iteration
-            if start_position == 0:
-                start_position = 1
+        while True:
+            job = self.jobs.get()
 
-            start_position = start_position + max_results
-            payload = "%s STARTPOSITION %s MAXRESULTS %s" % (original_payload,
-                    start_position, max_results)
+            if job is None:
+                return
 
-            data_set += r_dict['QueryResponse'][qb_object]
+            future, func, args, kwargs = job
 
-        #print "Records Found: %d." % len(data_set)
-        return data_set
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
 
-    def create_object(self, qbbo, request_body, content_type = "json"):
-        """
-        One of the four glorious CRUD functions.
-        Getting this right means using the correct object template and
-        and formulating a valid request_body. This doesn't help with that.
-        It just submits the request and adds the newly-created object to the
-        session's brain.
-        """
+    def submit(self, func, *args, **kwargs):
+        """Queues func(*args, **kwargs) and returns its Future."""
 
-        if qbbo not in self._BUSINESS_OBJECTS:
-            raise Exception("%s is not a valid QBO Business Object." % qbbo,
-                            " (Note that this validation is case sensitive.)")
+        if len(self.threads) < self.max_workers:
+            self.start()
 
-        url = "https://qb.sbfinance.intuit.com/v3/company/%s/%s" % \
-              (self.company_id, qbbo.lower())
+        future = Future()
 
-        if self.verbose:
+        self.jobs.put((future, func, args, kwargs))
 
-            print "About to create a(n) %s object with this request_body:" \
-                % qbbo
-            print request_body
+        return future
 
-        response = self.hammer_it("POST", url, request_body, content_type)
+    def shutdown(self, wait = True):
 
-        if qbbo in response:
+        with self.lock:
+            threads, self.threads = self.threads, []
 
-            new_object = response[qbbo]
+        for t in threads:
+            self.jobs.put(None)
 
-        else:
+        if wait:
+            for t in threads:
+                t.join()
 
-            print "It looks like the create failed. Here's the result:"
-            print response
+def wait_all(futures, timeout = None):
+    """Waits for every Future and returns their results, in order."""
 
-            return None
+    return [future.result(timeout) for future in futures]
 
-        new_Id     = new_object["Id"]
+class RateLimiter():
+    """
+    A token bucket: lets through up to `burst` requests at once, refilling
+    at `rate` requests per second. hold() stops everybody for a while
+    (e.g. when the server has told us to back off).
+    """
 
-        attr_name = qbbo+"s"
+    def __init__(self, rate, burst):
 
-        if not hasattr(self,attr_name):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.held_until = 0
+        self.lock = threading.Lock()
 
-            if self.verbose:
-                print "Creating a %ss attribute for this session." % qbbo
+    def acquire(self):
+        """Blocks until a request is allowed through."""
 
-            self.get_objects(qbbo).update({new_Id:new_object})
+        while True:
 
-        else:
+            with self.lock:
+                now = time.time()
 
-            if self.verbose:
-                print "Adding this new %s to the existing set of them." \
-                    % qbbo
-                print json.dumps(new_object, indent=4)
+                self.tokens = min(self.burst, self.tokens + \
+                                  (now - self.updated) * self.rate)
+                self.updated = now
 
-            getattr(self, attr_name)[new_Id] = new_object
+                if now < self.held_until:
+                    wait = self.held_until - now
 
-        return new_object
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
 
-    def read_object(self, qbbo, object_id, content_type = "json"):
-        """Makes things easier for an update because you just do a read,
-        tweak the things you want to change, and send that as the update
-        request body (instead of having to create one from scratch)."""
+                else:
+                    wait = (1 - self.tokens) / self.rate
 
-        url = "https://quickbooks.api.intuit.com/v3/company/%s/%s/%s" % \
-              (self.company_id, qbbo.lower(), object_id)
+            time.sleep(wait)
 
-        response = self.hammer_it("GET", url, None, content_type)
+    def hold(self, seconds):
+        """Lets nothing through for the next `seconds`."""
 
-        if not qbbo in response:
+        with self.lock:
+            self.held_until = max(self.held_until, time.time() + seconds)
+            self.tokens = 0
 
-            return response
+# one RateLimiter per realm, shared by every QuickBooks instance in the process
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
 
-        #otherwise we don't need the time (and outer shell)
+def rate_limiter_for(realm, rate, burst):
+    """Returns the process-wide RateLimiter for this realm."""
 
-        return response[qbbo]
+    with rate_limiters_lock:
+        if str(realm) not in rate_limiters:
+            rate_limiters[str(realm)] = RateLimiter(rate, burst)
 
-    def update_object(self, qbbo, Id, update_dict, content_type = "json"):
-        """
-        Generally before calling this, you want to call the read_object
-        command on what you want to update. The alternative is forming a valid
-        update request_body from scratch, which doesn't look like fun to me.
-        """
+        return rate_limiters[str(realm)]
 
-        if qbbo not in self._BUSINESS_OBJECTS:
-            raise Exception("%s is not a valid QBO Business Object." % qbbo,
-                            " (Note that this validation is case sensitive.)")
+class RequestMetrics():
+    """
+    A metrics callback (see QuickBooks.metrics_callbacks) that aggregates
+    request records into Prometheus-style histograms and counters, labelled
+    by realm, entity and operation. prometheus_text() renders them in the
+    Prometheus text exposition format, e.g. for a /metrics endpoint.
+    """
 
-        """
-        url = "https://qb.sbfinance.intuit.com/v3/company/%s/%s" % \
-              (self.company_id, qbbo.lower()) + "?operation=update"
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    BYTES_BUCKETS = (1024, 10240, 102400, 1048576, 10485760, 104857600)
 
-        url = "https://quickbooks.api.intuit.com/v3/company/%s/%s" % \
-              (self.company_id, qbbo.lower()) + "?requestid=%s" % Id
-        """
+    # (record key, metric name, buckets, help)
+    HISTOGRAMS = [
+        ("latency", "qbo_request_latency_seconds", LATENCY_BUCKETS,
+         "Time spent waiting on Intuit, summed over every attempt."),
+        ("throttle_wait", "qbo_request_throttle_seconds", LATENCY_BUCKETS,
+         "Time spent waiting on the realm's rate limiter."),
+        ("decode_time", "qbo_request_decode_seconds", LATENCY_BUCKETS,
+         "Time spent decoding responses."),
+        ("bytes", "qbo_response_bytes", BYTES_BUCKETS,
+         "Response body size, summed over every attempt."),
+    ]
 
-        #see this link for url troubleshooting info:
-        #http://stackoverflow.com/questions/23333300/whats-the-correct-uri-
-        # for-qbo-v3-api-update-operation/23340464#23340464
+    LABELS = ("realm", "entity", "operation")
 
-        url = "https://quickbooks.api.intuit.com/v3/company/%s/%s" % \
-              (self.company_id, qbbo.lower())
+    def __init__(self):
 
-        #work from the existing account json dictionary
-        e_dict = self.get_entity(qbbo, Id)
+        self.lock = threading.Lock()
 
-        udd = json.loads(update_dict)
+        #{metric name: {labels: [bucket counts, sum, count]}}
+        self.histograms = dict((name, {}) for _, name, _, _ in
+                               self.HISTOGRAMS)
 
-        e_dict.update(udd)
+        #{metric name: {labels: value}}
+        self.counters = {
+            "qbo_requests_total" : {},
+            "qbo_request_retries_total" : {},
+            "qbo_request_faults_total" : {},
+        }
 
-        request_body = json.dumps(e_dict, indent=4)
+    def __call__(self, record):
 
-        if self.verbose:
+        labels = tuple((key, str(record.get(key))) for key in self.LABELS)
 
-            print "About to update %s Id %s with this request_body:" \
-                % (qbbo, Id)
+        with self.lock:
 
-            print request_body
+            for key, name, buckets, _ in self.HISTOGRAMS:
 
-        response = self.hammer_it("POST", url, request_body, content_type)
+                value = record.get(key) or 0
 
-        if qbbo in response:
+                histogram = self.histograms[name].setdefault(
+                    labels, [[0] * len(buckets), 0, 0])
 
-            new_object = response[qbbo]
+                for i, bound in enumerate(buckets):
+                    if value <= bound:
+                        histogram[0][i] += 1
 
-        else:
+                histogram[1] += value
+                histogram[2] += 1
 
-            print "It looks like the create failed. Here's the result:"
-            print response
+            self.count("qbo_requests_total", labels, 1)
+            self.count("qbo_request_retries_total", labels,
+                       record.get("retries", 0))
 
-            return None
+            if record.get("fault") is not None:
+                self.count("qbo_request_faults_total",
+                           labels + (("fault", str(record["fault"])),), 1)
 
-        attr_name = qbbo+"s"
+    def count(self, name, labels, value):
 
-        if not hasattr(self,attr_name):
+        counter = self.counters[name]
+        counter[labels] = counter.get(labels, 0) + value
 
-            if self.verbose:
-                print "Creating a %ss attribute for this session." % qbbo
+    @staticmethod
+    def format_labels(labels):
 
-            self.get_objects(attr_name).update({new_Id:new_object})
+        def escape(value):
+            return value.replace("\\", "\\\\").replace('"', '\\"')\
+                        .replace("\n", "\\n")
 
-        else:
+        return "{%s}" % ",".join('%s="%s"' % (key, escape(value))
+                                 for key, value in labels)
 
-            if self.verbose:
-                print "Adding this new %s to the existing set of them." \
-                    % qbbo
-                print json.dumps(new_object, indent=4)
+    def prometheus_text(self):
+        """The aggregated metrics, in Prometheus' text format."""
 
-            getattr(self, attr_name)[Id] = new_object
+        lines = []
 
-        return new_object
+        with self.lock:
 
-    def delete_object(self, qbbo, object_id, content_type = "json"):
-        """Don't need to give it an Id, just the whole object as returned by
-        a read operation."""
+            for _, name, buckets, help_text in self.HISTOGRAMS:
 
-        json_dict = self.read_object(qbbo, object_id)
+                lines.append("# HELP %s %s" % (name, help_text))
+                lines.append("# TYPE %s histogram" % name)
 
-        if not 'Id' in json_dict:
+                for labels, (counts, total, count) in \
+                    sorted(self.histograms[name].items()):
 
-            return "NO OBJECT FOUND"
+                    for bound, bucket_count in zip(buckets, counts):
+                        lines.append("%s_bucket%s %d" % (name,
+                            self.format_labels(labels + (("le",
+                                                          repr(bound)),)),
+                            bucket_count))
 
-        request_body = json.dumps(json_dict, indent=4)
+                    lines.append("%s_bucket%s %d" % (name,
+                        self.format_labels(labels + (("le", "+Inf"),)),
+                        count))
+                    lines.append("%s_sum%s %r" % (name,
+                        self.format_labels(labels), total))
+                    lines.append("%s_count%s %d" % (name,
+                        self.format_labels(labels), count))
 
-        url = "https://quickbooks.api.intuit.com/v3/company/%s/%s" % \
-              (self.company_id, qbbo.lower())
+            for name in sorted(self.counters):
 
-        response = self.hammer_it("POST", url, request_body, content_type,
-                                  **{"params":{"operation":"delete"}})
+                lines.append("# TYPE %s counter" % name)
 
-        if not qbbo in response:
+                for labels, value in sorted(self.counters[name].items()):
+                    lines.append("%s%s %d" % (name, self.format_labels(labels),
+                                              value))
 
-            return response
+        return "\n".join(lines) + "\n"
 
-        return response[qbbo]
+class Ref(object):
+    """A shared, immutable stand-in for a {"value": .., "name": ..} ref."""
 
-    def upload_file(self, path, name = "same", upload_type = "automatic",
-                    qbbo = None, Id = None):
-        """
-        Uploads a file that can be linked to a specific transaction (or other
-         entity probably), or not...
+    __slots__ = ("value", "name", "type")
 
-        Either way, it should return the id the attachment.
-        """
+    def __init__(self, value, name = None, type = None):
+        self.value = value
+        self.name = name
+        self.type = type
 
-        url = "https://quickbooks.api.intuit.com/v3/company/%s/upload" % \
-              self.company_id
+    def to_dict(self):
+        d = {"value" : self.value}
 
-        filename         = path.rsplit("/",1)[-1]
+        if self.name is not None:
+            d["name"] = self.name
 
-        bare_name, extension = filename.rsplit(".",1)
+        if self.type is not None:
+            d["type"] = self.type
 
-        if upload_type == "automatic":
+        return d
 
-            upload_type = "application/%s" % extension
+# what an unassigned CompactLine/CompactEntity slot reads as (None can't
+# mean "missing", since a field can be there with a null value)
+UNSET = object()
 
-        if name == "same":
+def read_only(*args):
+    raise TypeError("Cached objects are read-only; " + \
+                    "change a copy from to_dict() instead")
 
-            name = bare_name
+class ReadOnlyDict(dict):
+    """What a CompactEntity's dict fields read as: changing one raises
+    (rather than quietly changing a copy), and copies are plain dicts."""
 
-        files = {
+    __setitem__ = __delitem__ = read_only
+    clear = pop = popitem = setdefault = update = read_only
 
-            'file' : (
-                'my_invoice.pdf',
-                open(path, 'rb'),
-                'application/pdf'
-            )
+    def __copy__(self):
+        return dict(self)
 
-        }
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
 
-        self.verbosity = 10
+class ReadOnlyList(list):
+    """ReadOnlyDict's counterpart for list fields (like Line)."""
 
-        request_body = files
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = read_only
+    __iadd__ = __imul__ = read_only
+    append = extend = insert = pop = remove = reverse = sort = read_only
 
-        result = self.hammer_it("POST", url, request_body,
-                                "multipart/formdata", files=files)
+    def __copy__(self):
+        return list(self)
 
-        attachment_id = None
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(list(self), memo)
 
-        return attachment_id
+class CompactLine(object):
+    """One transaction line, with its detail packed (see Compactor)."""
 
-    def download_file(self, attachment_id, destination_path=""):
-        """
-        Download a file to the requested (or default) directory, then also
-         return a download link for convenience.
-        """
-        url = "https://quickbooks.api.intuit.com/v3/company/%s/download/%s" % \
-              (self.company_id, attachment_id)
+    __slots__ = ("Id", "LineNum", "Description", "Amount", "DetailType",
+                 "detail", "rest")
 
-        # Custom accept for file link!
-        link =  self.hammer_it("GET", url, None, "json", accept="filelink")
+    def to_dict(self):
 
-        # No session required for file download
-        my_r = requests.get(link)
-        if my_r.status_code:
-            filename = my_r.url.split("%2F")[2].split("?")[0]
-            with open(destination_path + filename, 'wb') as f:
-                for chunk in my_r.iter_content(1024):
-                    f.write(chunk)
-        return link
+        d = {}
 
-    def hammer_it(self, request_type, url, request_body, content_type,
-                  accept = 'json', files=None, **req_kwargs):
-        """
-        A slim version of simonv3's excellent keep_trying method. Among other
-         trimmings, it assumes we can only use v3 of the
-         QBO API. It also allows for requests and responses
-         in xml OR json. (No xml parsing added yet but the way is paved...)
-        """
+        for field in ("Id", "LineNum", "Description", "Amount", "DetailType"):
+            value = getattr(self, field, UNSET)
 
-        if self.session != None:
-            session = self.session
-        else:
+            if value is not UNSET:
+                d[field] = value
 
-            #print "Creating new session! (Why wouldn't we have a session!?)"
-            #because __init__doesn't do it!
+        if self.detail is not UNSET:
+            d[self.DetailType] = Compactor.unpack(self.detail)
 
-            session = self.create_session()
-            self.session = session
+        if self.rest is not None:
+            d.update(Compactor.unpack(self.rest))
 
-        #haven't found an example of when this wouldn't be True, but leaving
-        #it for the meantime...
+        return d
 
-        header_auth = True
+class CompactEntity(object):
+    """
+    Base for the slotted entity classes Compactor builds: the common fields
+    live in slots (refs as shared Ref objects, lines as CompactLines), and
+    everything else stays a compact json string until someone asks for it.
 
-        trying       = True
-        print_error  = False
+    Reads like the original dict (o["Id"], o.get(..), "x" in o), but what
+    it hands out is read-only (see ReadOnlyDict), since it's rebuilt on
+    every read. to_dict() gives back exactly the dict it was made from, to
+    change as you like.
+    """
 
-        tries = 0
+    __slots__ = ("extra",)
 
-        while trying:
+    FIELDS = ()
 
-            tries += 1
+    # the decoded extras of the entities read most recently, keyed by their
+    # json, so a run of lookups on one entity only decodes it once
+    decoded = collections.OrderedDict()
+    decoded_size = 256
+    decoded_lock = threading.Lock()
 
-            if tries > 1:
+    def extras(self):
+        if self.extra is None:
+            return {}
 
-                #we don't want to get shut out...
+        return default_codec.decode(self.extra)
 
-                if self.verbose:
+    def read_extras(self):
+        """extras(), read-only and decoded at most once in a while."""
 
-                    pass
-                    #print "Sleeping for a second to appease the server."
+        if self.extra is None:
+            return ReadOnlyDict()
 
-                time.sleep(1)
+        cls = CompactEntity
 
+        with cls.decoded_lock:
+            extras = cls.decoded.pop(self.extra, None)
 
-            if self.verbose and tries > 1:
-                print "(this is try#%d)" % tries
+            if extras is None:
+                extras = Compactor.freeze(default_codec.decode(self.extra))
 
-            if accept == "filelink":
-                headers = {}
-            else:
-                headers = {
-                    'Accept': 'application/%s' % accept
-                    }
+            #back to the most-recently-used end
+            cls.decoded[self.extra] = extras
 
-            if not request_type == "GET" and files == None:
+            while len(cls.decoded) > cls.decoded_size:
+                cls.decoded.popitem(last = False)
 
-                headers.update({
+        return extras
 
-                    'Content-Type': 'application/%s' % content_type
+    def to_dict(self):
 
-                })
+        d = self.extras()
 
-            elif not files == None:
+        for field in self.FIELDS:
+            value = getattr(self, field, UNSET)
 
-                headers.update({
+            if value is not UNSET:
+                d[field] = Compactor.unpack(value)
 
-                    'Content-Type': 'application/application/multipart/form-data'
+        return d
 
-                })
+    def __getitem__(self, key):
 
-                request_body = files
+        if key in self.FIELDS:
+            value = getattr(self, key, UNSET)
 
-            my_r = session.request(request_type, url, header_auth,
-                                self.company_id, headers = headers,
-                                data = request_body, **req_kwargs)
+            if value is UNSET:
+                raise KeyError(key)
 
-            #import ipdb
-            #ipdb.set_trace()
+            return Compactor.freeze(Compactor.unpack(value))
 
-            if accept == "json":
+        return self.read_extras()[key]
 
-                try:
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
-                    result = my_r.json()
+    def __contains__(self, key):
 
-                except:
+        if key in self.FIELDS:
+            return getattr(self, key, UNSET) is not UNSET
 
-                    if self.verbose or self.verbosity > 0:
-                        print my_r,
+        return key in self.read_extras()
 
-                        if my_r.status_code in [503]:
+    def keys(self):
+        return self.to_dict().keys()
 
-                            print " (Service Unavailable)"
+class Compactor():
+    """
+    Turns business object dicts into slotted CompactEntity objects for the
+    types in ENTITY_FIELDS (anything else is passed through untouched).
+    Repeated strings are interned and identical refs share one Ref object,
+    so a tenant's worth of cached objects takes a fraction of the memory.
+    """
 
-                        elif my_r.status_code in [401]:
+    ENTITY_FIELDS = {
+        "Invoice" : ("Id", "SyncToken", "DocNumber", "TxnDate", "DueDate",
+                     "TotalAmt", "Balance", "CustomerRef", "CurrencyRef",
+                     "Line"),
+        "Bill" : ("Id", "SyncToken", "DocNumber", "TxnDate", "DueDate",
+                  "TotalAmt", "Balance", "VendorRef", "APAccountRef",
+                  "CurrencyRef", "Line"),
+        "Purchase" : ("Id", "SyncToken", "DocNumber", "TxnDate", "TotalAmt",
+                      "PaymentType", "AccountRef", "EntityRef", "CurrencyRef",
+                      "Line"),
+        "JournalEntry" : ("Id", "SyncToken", "DocNumber", "TxnDate",
+                          "Adjustment", "CurrencyRef", "Line"),
+        "Customer" : ("Id", "SyncToken", "DisplayName", "CompanyName",
+                      "Active", "Balance", "CurrencyRef"),
+        "Account" : ("Id", "SyncToken", "Name", "FullyQualifiedName",
+                     "AccountType", "AccountSubType", "Active",
+                     "CurrentBalance", "CurrencyRef"),
+        "Item" : ("Id", "SyncToken", "Name", "FullyQualifiedName", "Type",
+                  "Active", "UnitPrice", "IncomeAccountRef",
+                  "ExpenseAccountRef")
+    }
 
-                            print " (Unauthorized -- a dubious response)"
+    LINE_FIELDS = ("Id", "LineNum", "Description", "Amount", "DetailType")
 
-                        else:
+    classes = {}
 
-                            print " (json parse failed)"
+    def __init__(self):
 
-                    if self.verbosity > 8:
+        self.lock = threading.Lock()
+        self.strings = {}
+        self.refs = {}
 
-                        print my_r.text
+    @classmethod
+    def entity_class(cls, qbbo):
 
-                    result = {"Fault" : {"type":"(inconclusive)"}}
+        if qbbo not in cls.classes:
+            fields = cls.ENTITY_FIELDS[qbbo]
 
-                if "Fault" in result and \
-                   "type" in result["Fault"] and \
-                   result["Fault"]["type"] == "ValidationFault":
+            cls.classes[qbbo] = type(str("Compact" + qbbo), (CompactEntity,),
+                                     {"__slots__" : fields,
+                                      "FIELDS" : fields,
+                                      "qbbo" : qbbo})
 
-                    if self.verbose or self.verbosity > 0:
+        return cls.classes[qbbo]
 
-                        print "Fault alert!"
+    def intern(self, value):
+        return self.strings.setdefault(value, value)
 
-                    trying = False
-                    print_error = True
+    def pack(self, value):
+        """Interns strings and shares refs, all the way down."""
 
-                elif tries >= 10:
+        if isinstance(value, basestring):
+            return self.intern(value)
 
-                    trying = False
+        if isinstance(value, dict):
 
-                    if "Fault" in result:
-                        print_error = True
+            if "value" in value and \
+               set(value.keys()) <= set(["value", "name", "type"]) and \
+               all(isinstance(v, basestring) for v in value.values()):
 
-                elif "Fault" not in result:
+                key = (value.get("value"), value.get("name"), value.get("type"))
 
-                    #sounds like a success
-                    trying = False
+                ref = self.refs.get(key)
 
-                if (not trying and print_error) or \
-                   self.verbosity > 8:
+                if ref is None:
+                    ref = self.refs[key] = Ref(*[self.intern(k) if k else k
+                                                 for k in key])
 
-                    print json.dumps(result, indent=1)
+                return ref
 
-            elif accept== 'filelink':
-                return my_r.text
-            else:
-                raise NotImplementedError("How do I parse a %s response?") \
-                    % accept
+            packed = {}
 
-        return result
+            for k, v in value.items():
+                packed[self.intern(k)] = self.pack(v)
 
-    def keep_trying(self, r_type, url, header_auth, realm, payload=''):
-        """ Wrapper script to session.request() to continue trying at the QB
-        API until it returns something good, because the QB API is
-        inconsistent """
-        if self.session != None:
-            session = self.session
-        else:
-            session = self.create_session()
-            self.session = session
+            return packed
 
-        trying = True
-        tries = 0
-        while trying:
-            tries += 1
+        if isinstance(value, list):
+            return [self.pack(v) for v in value]
 
-            if tries > 1:
+        return value
 
-                if self.verbose:
+    @staticmethod
+    def unpack(value):
+        """The inverse of pack."""
 
-                    pass
-                    #print "Sleeping for a second to appease the server."
+        if isinstance(value, (Ref, CompactLine)):
+            return value.to_dict()
 
-                time.sleep(1)
+        if isinstance(value, dict):
+            return dict((k, Compactor.unpack(v)) for k, v in value.items())
 
-            if self.verbose and tries > 1:
-                print "(this is try#%d)" % tries
+        if isinstance(value, list):
+            return [Compactor.unpack(v) for v in value]
 
+        return value
 
-            if "v2" in url:
-                r = session.request(r_type, url, header_auth,
-                                    realm, data=payload)
+    @staticmethod
+    def freeze(value):
+        """value with its dicts and lists made read-only, all the way down."""
 
-                r_dict = xmltodict.parse(r.text)
+        if isinstance(value, dict):
+            return ReadOnlyDict((k, Compactor.freeze(v))
+                                for k, v in value.items())
 
-                if "FaultInfo" not in r_dict or tries > 10:
-                    trying = False
-            else:
-                headers = {
-                        'Content-Type': 'application/text',
-                        'Accept': 'application/json'
-                    }
+        if isinstance(value, list):
+            return ReadOnlyList(Compactor.freeze(v) for v in value)
 
-                #print r_type,url,header_auth,realm,headers,payload
-                #quit()
-                r = session.request(r_type, url, header_auth, realm,
-                                    headers = headers, data = payload)
+        return value
 
-                try:
+    def pack_line(self, line):
 
-                    r_dict = r.json()
+        compact = CompactLine()
+        rest = {}
 
-                except:
+        for k, v in line.items():
+            if k not in self.LINE_FIELDS:
+                rest[k] = v
 
-                    #I've seen, e.g. a ValueError ("No JSON object could be
-                    #decoded"), but there could be other errors here...
+        #fields the line doesn't have stay unassigned
+        for field in self.LINE_FIELDS:
+            if field in line:
+                setattr(compact, field, self.pack(line[field]))
 
-                    if self.verbose:
+        detail_type = line.get("DetailType")
 
-                        pass
+        if detail_type is not None and detail_type in rest:
+            compact.detail = self.pack(rest.pop(detail_type))
+        else:
+            compact.detail = UNSET
 
-                        #print "failed to decode JSON object..."
+        compact.rest = self.pack(rest) if rest else None
 
-                        #import traceback
-                        #traceback.print_exc()
+        return compact
 
-                    r_dict = {"Fault":{"type":"(Inconclusive)"}}
+    def compact(self, qbbo, o):
+        """Returns the slotted version of o (or o itself, if qbbo has none)."""
 
-                if "Fault" not in r_dict or tries > 10:
+        if qbbo not in self.ENTITY_FIELDS or isinstance(o, CompactEntity):
+            return o
 
-                    trying = False
+        entity = self.entity_class(qbbo)()
+        extra = {}
 
-                elif "Fault" in r_dict and r_dict["Fault"]["type"]==\
-                     "AUTHENTICATION":
+        with self.lock:
+            for k, v in o.items():
 
-                    #Initially I thought to quit here, but actually
-                    #it appears that there are 'false' authentication
-                    #errors all the time and you just have to keep trying...
+                if k not in entity.FIELDS:
+                    extra[k] = v
 
-                    trying = True
+                elif k == "Line" and isinstance(v, list) and \
+                     all(isinstance(line, dict) for line in v):
+                    entity.Line = [self.pack_line(line) for line in v]
 
-        if "Fault" in r_dict:
-            print r_dict
+                else:
+                    setattr(entity, k, self.pack(v))
 
-        return r_dict
+        entity.extra = default_codec.encode(extra) if extra else None
 
-    def fetch_customer(self, pk):
-        if pk:
-            url = self.base_url_v3 + "/company/%s/customer/%s" % \
-                  (self.company_id, pk)
+        return entity
 
-            # url = self.base_url_v2 + "/resource/customer/v2/%s/%s" % \
-            #    ( self.company_id, pk)
+class RefIndex():
+    """
+    An inverted index from the Ids in CustomerRef, ClassRef, AccountRef,
+    ItemRef and DepartmentRef to the cached transactions (and the positions
+    of the lines within them) that reference them. Header-level refs are
+    recorded with a line position of None.
+    """
 
-            r_dict = self.keep_trying("GET", url, True, self.company_id)
-            return r_dict['Customer']
+    REF_TYPES = ["CustomerRef", "ClassRef", "AccountRef", "ItemRef",
+                 "DepartmentRef"]
 
+    def __init__(self):
 
-    def fetch_customers(self, all=False, page_num=0, limit=10):
-        if self.session != None:
-            session = self.session
-        else:
-            session = self.create_session()
-            self.session = session
+        self.lock = threading.Lock()
 
-        # Sometimes we use v2 of the API
-        url = self.base_url_v2
-        url += "/resource/customers/v2/%s" % (self.company_id)
+        #{(ref_type, ref_id): {(qbbo, Id): [line positions]}}
+        self.refs = {}
 
-        customers = []
+        #{(qbbo, Id): [(ref_type, ref_id)]}, so objects can be taken out again
+        self.postings = {}
 
-        if all:
-            counter = 1
-            more = True
+        #which Business Object types have been indexed
+        self.qbbos = set()
 
-            while more:
-                payload = {
-                    "ResultsPerPage":30,
-                    "PageNum":counter,
-                    }
+    def refs_in(self, o):
+        """Returns {(ref_type, ref_id): [line positions]} for one object."""
 
-                trying = True
+        found = {}
 
-                # Because the QB API is so iffy, let's try until we get an
-                # non-error
+        def note(ref_type, ref, position):
+            if isinstance(ref, dict) and "value" in ref:
+                found.setdefault((ref_type, ref["value"]), []).append(position)
 
-                # Rewrite this to use same code as above.
-                while trying:
-                    r = session.request("POST", url, header_auth = True,
-                                        data = payload, realm = self.company_id)
+        for ref_type in self.REF_TYPES:
+            if ref_type in o:
+                note(ref_type, o[ref_type], None)
 
-                    root = ET.fromstring(r.text)
+        for position, line in enumerate(o.get("Line", [])):
+            for key, detail in line.items():
 
-                    if root[1].tag != "{http://www.intuit.com/sb/" + \
-                       "cdm/baseexceptionmodel/xsd}ErrorCode":
+                if not key.endswith("Detail") or not isinstance(detail, dict):
+                    continue
 
-                        trying = False
+                for ref_type in self.REF_TYPES:
+                    if ref_type in detail:
+                        note(ref_type, detail[ref_type], position)
 
-                    else:
+                #journal entry lines name their customer as an Entity
+                entity = detail.get("Entity")
 
-                        print "Failed"
+                if isinstance(entity, dict) and \
+                   entity.get("Type") == "Customer":
+                    note("CustomerRef", entity.get("EntityRef"), position)
 
-                session.close()
+        return found
 
-                qb_name = "{http://www.intuit.com/sb/cdm/v2}"
+    def update(self, qbbo, objects, deleted_ids = [], replace = False):
+        """
+        (Re)indexes objects and drops deleted_ids. With replace=True
+        everything previously indexed for this type is dropped first.
+        """
 
-                for child in root:
-                    if child.tag == "{http://www.intuit.com/sb/cdm/qbo}Count":
+        with self.lock:
 
-                        if int(child.text) < 30:
-                            more = False
-                            print "Found all customers"
+            if replace:
+                for key in [key for key in self.postings if key[0] == qbbo]:
+                    self.remove(key)
 
-                    if child.tag == "{http://www.intuit.com/sb/" + \
-                       "cdm/qbo}CdmCollections":
+            self.qbbos.add(qbbo)
 
-                        for customer in child:
+            for Id in deleted_ids:
+                self.remove((qbbo, Id))
 
-                            customers += [xmltodict.parse(
-                                ET.tostring(customer))]
+            for o in objects:
+                key = (qbbo, o["Id"])
 
-                counter += 1
+                self.remove(key)
 
-                # more = False
+                found = self.refs_in(o)
 
-        else:
+                for ref, positions in found.items():
+                    self.refs.setdefault(ref, {})[key] = positions
 
-            payload = {
-                "ResultsPerPage":str(limit),
-                "PageNum":str(page_num),
-                }
+                self.postings[key] = found.keys()
 
-            r = session.request("POST", url, header_auth = True,
-                                data = payload, realm = self.company_id)
+    def remove(self, key):
+        """Takes one (qbbo, Id) out of the index (call with the lock held)."""
 
-            root = ET.fromstring(r.text)
+        for ref in self.postings.pop(key, []):
+            postings = self.refs.get(ref)
 
-            #TODO: parse for all customers
+            if postings is not None:
+                postings.pop(key, None)
 
+                if len(postings) == 0:
+                    del self.refs[ref]
 
-        return customers
+    def lookup(self, ref_type, ref_id, qbbo_list = None):
+        """Returns {(qbbo, Id): [line positions]} for everything citing it."""
 
-    def fetch_sales_term(self, pk):
-        if pk:
-            url = self.base_url_v2 + "/resource/sales-term/v2/%s/%s" % \
-                  ( self.company_id, pk)
+        with self.lock:
+            postings = dict(self.refs.get((ref_type, str(ref_id)), {}))
 
-            r_dict = self.keep_trying("GET", url, True, self.company_id)
-            return r_dict
+        if qbbo_list is not None:
+            for key in postings.keys():
+                if key[0] not in qbbo_list:
+                    del postings[key]
 
-    def fetch_invoices(self, **args):
-        qb_object = "Invoice"
-        payload = "SELECT * FROM %s" % (qb_object)
-        if "query" in args:
-            if "customer" in args['query']:
-                payload = ("SELECT * FROM %s WHERE "
-                    "CustomerRef = '%s'") % (
-                        qb_object, args['query']['customer']
-                        )
+        return postings
 
-        r_dict = self.query_fetch_more("POST", True,
-                self.company_id, qb_object, payload)
+class ReportCache():
+    """
+    A size-bounded, least-recently-used cache of (flattened) reports that
+    forgets entries after ttl seconds. Keyed by report name and params, so
+    {"start_date": "2015-01-01"} and {"start_date": u"2015-01-01"} in any
+    order are the same report. Reports go in and come out as copies, so
+    callers are free to change what they're given.
+    """
 
-        return r_dict
+    def __init__(self, max_entries = 128, ttl = 300):
 
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
 
-    def fetch_purchases(self, **args):
-        # if "query" in args:
-            qb_object = "Purchase"
-            payload = ""
-            if "query" in args and "customer" in args['query']:
+    @staticmethod
+    def key(report_name, params):
+        #strings as they are (u"a" and "a" are equal, and hash the same),
+        #anything else (a date, say) as unicode
+        return (report_name, tuple(sorted(
+            (k, v if isinstance(v, basestring) else unicode(v))
+            for k, v in params.items())))
 
-                # if there is a customer, let's get the create date
-                # for that customer in QB, all relevant purchases will be
-                # after that date, this way we need less from QB
+    def get(self, report_name, params):
+        """The cached report, or None if it isn't there (or is too old)."""
 
-                customer = self.fetch_customer(args['query']['customer'])
+        key = self.key(report_name, params)
 
-                # payload = "SELECT * FROM %s" % (qb_object)
-                payload = "SELECT * FROM %s WHERE MetaData.CreateTime > '%s'" \
-                          % (qb_object, customer['MetaData']['CreateTime'])
+        with self.lock:
+            entry = self.entries.pop(key, None)
 
-            else:
+            if entry is None:
+                return None
 
-                payload = "SELECT * FROM %s" % (qb_object)
+            stored_at, report = entry
 
-            unfiltered_purchases = self.query_fetch_more("POST", True,
-                self.company_id, qb_object, payload)
+            if time.time() - stored_at > self.ttl:
+                return None
 
-            filtered_purchases = []
+            #back to the most-recently-used end
+            self.entries[key] = entry
 
-            if "query" in args and "customer" in args['query']:
-                for entry in unfiltered_purchases:
+        return copy.deepcopy(report)
 
-                    if (
-                        'Line' in entry
-                        ):
-                        for line in entry['Line']:
-                            if (
-                                'AccountBasedExpenseLineDetail' in line and \
-                                'CustomerRef' in \
-                                    line['AccountBasedExpenseLineDetail'] and \
-                                    line['AccountBasedExpenseLineDetail']\
-                                    ['CustomerRef']['value'] == \
-                                    args['query']['customer']
-                                ):
+    def put(self, report_name, params, report):
 
-                                filtered_purchases += [entry]
+        key = self.key(report_name, params)
+        report = copy.deepcopy(report)
 
-                return filtered_purchases
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), report)
 
-            else:
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last = False)
 
-                return unfiltered_purchases
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
 
-    def fetch_journal_entries(self, **args):
-        """ Because of the beautiful way that journal entries are organized
-        with QB, you're still going to have to filter these results for the
-        actual entity you're interested in.
+def flatten_report(report):
+    """
+    Flattens a QBO report's nested Rows/ColData sections into one list of
+    rows, each a dict of:
+        kind    "Header", "Data" or "Summary"
+        depth   how many sections deep it sits
+        path    the labels of the sections it sits in
+        group   the QBO group of its section (e.g. "Income"), if any
+        values  the cells, typed by column: Money/Number columns as floats,
+                blanks as None, everything else as strings
+        ids     the ids QBO gives some cells (accounts etc.), or None
+    Returns {"header": report["Header"], "columns": [...], "rows": [...]},
+    where columns are {"title", "type"} dicts.
+    """
 
-        :param query: a dictionary that includes 'customer',
-        and the QB id of the customer
-        """
+    columns = [{"title" : column.get("ColTitle"),
+                "type" : column.get("ColType")}
+               for column in report.get("Columns", {}).get("Column", [])]
 
-        payload = {}
-        more = True
+    numeric = [column["type"] in ["Money", "Number", "Amount"]
+               for column in columns]
 
-        journal_entries = []
-        max_results = 500
-        start_position = 0
+    def typed(position, cell):
+        value = cell.get("value")
 
-        if "query" in args and "project" in args['query']:
-            original_payload = "SELECT * FROM JournalEntry"
+        if value is None or value == "":
+            return None
 
-        elif "query" in args and "raw" in args['query']:
-            original_payload = args['query']['raw']
+        if position < len(numeric) and numeric[position]:
+            try:
+                return float(value)
+            except ValueError:
+                return value
 
-        else:
-            original_payload = "SELECT * FROM JournalEntry"
+        return value
 
-        payload = original_payload + " MAXRESULTS " + str(max_results)
+    rows = []
 
-        while more:
+    def walk(row_list, depth, path, group):
 
-            url = self.base_url_v3 + "/company/%s/query" % (self.company_id)
+        for row in row_list:
 
-            r_dict = self.keep_trying("POST", url, True, self.company_id,
-                                      payload)
+            row_group = row.get("group", group)
 
-            if int(r_dict['QueryResponse']['totalCount']) < max_results:
-                more = False
-            if start_position == 0:
-                start_position = 1
-            start_position = start_position + max_results
-            payload = "%s STARTPOSITION %s MAXRESULTS %s" % \
-                      (original_payload, start_position, max_results)
-            journal_entry_set = r_dict['QueryResponse']['JournalEntry']
+            for kind, part in [("Header", row.get("Header")),
+                               ("Data", row if "ColData" in row else None)]:
+                if part is None or "ColData" not in part:
+                    continue
 
-            # This has to happen because the QBO API doesn't support
-            # filtering along customers apparently.
-            if "query" in args and "class" in args['query']:
-                for entry in journal_entry_set:
-                    for line in entry['Line']:
-                        if 'JournalEntryLineDetail' in line:
-                            if 'ClassRef' in line['JournalEntryLineDetail']:
-                                if args['query']['class'] in \
-                                   line['JournalEntryLineDetail']\
-                                   ['ClassRef']['name']:
+                cells = part["ColData"]
 
-                                    journal_entries += [entry]
+                rows.append({"kind" : kind, "depth" : depth,
+                             "path" : path, "group" : row_group,
+                             "values" : [typed(i, cell) for i, cell in
+                                         enumerate(cells)],
+                             "ids" : [cell.get("id") for cell in cells]})
 
-                                    break
+            if "Rows" in row:
+                label = None
 
-            else:
+                if "Header" in row and row["Header"].get("ColData"):
+                    label = row["Header"]["ColData"][0].get("value")
 
-                journal_entries = journal_entry_set
+                walk(row["Rows"].get("Row", []), depth + 1, path + (label,),
+                     row_group)
 
-        return journal_entries
+            if "Summary" in row and "ColData" in row["Summary"]:
+                cells = row["Summary"]["ColData"]
 
-    def fetch_bills(self, **args):
-        """Fetch the bills relevant to this project."""
-        # if "query" in args:
-        payload = {}
-        more = True
-        counter = 1
-        bills = []
-        max_results = 500
-        start_position = 0
-        if "query" in args and "customer" in args['query']:
-            original_payload = "SELECT * FROM Bill"
+                rows.append({"kind" : "Summary", "depth" : depth,
+                             "path" : path, "group" : row_group,
+                             "values" : [typed(i, cell) for i, cell in
+                                         enumerate(cells)],
+                             "ids" : [cell.get("id") for cell in cells]})
+
+    walk(report.get("Rows", {}).get("Row", []), 0, (), None)
+
+    return {"header" : report.get("Header"), "columns" : columns,
+            "rows" : rows}
+
+# reports whose figures for a date range are the sum of their figures for
+# its parts (activity, not balances), so merge_reports can add them up
+ADDITIVE_REPORTS = ["GeneralLedger", "TransactionList", "JournalReport",
+                    "ProfitAndLoss", "ProfitAndLossDetail", "CustomerSales",
+                    "CustomerIncome", "ItemSales", "VendorExpenses"]
+
+def merge_reports(reports, start_date, end_date):
+    """
+    Merges reports for consecutive date ranges back into one, as if it had
+    been asked for start_date..end_date in one go: sections are matched up
+    by group and header label (a section first seen in a later report goes
+    in after the section it follows there), Data rows are concatenated in
+    date order, and Summary rows add up their Money columns. Running
+    "Balance" columns take the last shard's value, and "Beginning Balance"
+    rows are only kept from the first shard. That's only right for the
+    ADDITIVE_REPORTS; point-in-time reports (BalanceSheet, TrialBalance,
+    the Aged* ones) can't be merged.
+
+    Columns are matched by position, so every report has to have the same
+    column titles (which rules out summarize_column_by periods).
+    """
+
+    if len(reports) == 1:
+        return reports[0]
+
+    def titles(report):
+        return [column.get("ColTitle") for column in
+                report.get("Columns", {}).get("Column", [])]
+
+    for report in reports[1:]:
+        if titles(report) != titles(reports[0]):
+            raise Exception("Can't merge reports with different columns: "
+                            "%s and %s" % (titles(reports[0]), titles(report)))
+
+    merged = copy.deepcopy(reports[0])
+
+    header = merged.setdefault("Header", {})
+    header["StartPeriod"] = start_date
+    header["EndPeriod"] = end_date
+
+    columns = merged.get("Columns", {}).get("Column", [])
+
+    money = [column.get("ColType") == "Money" and \
+             column.get("ColTitle") != "Balance" for column in columns]
+
+    def label(row):
+        cells = row.get("Header", {}).get("ColData") or \
+                row.get("Summary", {}).get("ColData") or [{}]
+
+        return (row.get("group"), cells[0].get("value"))
+
+    def add_summaries(into, other):
+        for i, (cell, other_cell) in enumerate(zip(into, other)):
+            if i < len(money) and money[i]:
+                try:
+                    total = float(cell.get("value") or 0) + \
+                            float(other_cell.get("value") or 0)
+                    cell["value"] = "%.2f" % total
+                except ValueError:
+                    pass
+            else:
+                #e.g. a running balance: the latest one stands
+                cell["value"] = other_cell.get("value", cell.get("value"))
+
+    def merge_rows(into, other):
+        """Merges the row list `other` into the row list `into`."""
+
+        sections = {}
+
+        for row in into:
+            if "Rows" in row or "Summary" in row:
+                sections[label(row)] = row
+
+        #the section in `into` that the last section of `other` matched
+        previous = None
+
+        for row in other:
+
+            if "Rows" not in row and "Summary" not in row:
+                cells = row.get("ColData", [{}])
+
+                if cells and cells[0].get("value") == "Beginning Balance":
+                    continue
+
+                into.append(row)
+                continue
+
+            existing = sections.get(label(row))
+
+            if existing is None:
+                #keep report order: right after the section it follows, or
+                #ahead of every section if it comes first
+                positions = [i for i, r in enumerate(into)
+                             if "Rows" in r or "Summary" in r]
+
+                if previous is not None:
+                    position = [i for i, r in enumerate(into)
+                                if r is previous][0] + 1
+                elif positions:
+                    position = positions[0]
+                else:
+                    position = len(into)
+
+                into.insert(position, row)
+                sections[label(row)] = row
+                previous = row
+                continue
+
+            previous = existing
+
+            if "Rows" in row:
+                merge_rows(existing.setdefault("Rows", {})
+                                   .setdefault("Row", []),
+                           row["Rows"].get("Row", []))
+
+            if "Summary" in row:
+                if "Summary" in existing:
+                    add_summaries(existing["Summary"].get("ColData", []),
+                                  row["Summary"].get("ColData", []))
+                else:
+                    existing["Summary"] = row["Summary"]
+
+    rows = merged.setdefault("Rows", {}).setdefault("Row", [])
+
+    for report in reports[1:]:
+        merge_rows(rows, report.get("Rows", {}).get("Row", []))
+
+    return merged
+
+def timed_iter(iterable, metrics, key = "decode_time"):
+    """
+    Yields from iterable, adding the time spent producing each item (but
+    not the time the consumer spends on it) to metrics[key].
+    """
+
+    iterator = iter(iterable)
+
+    while True:
+        started = time.time()
+
+        try:
+            item = next(iterator)
+        finally:
+            metrics[key] += time.time() - started
+
+        yield item
+
+def xml_local_name(tag):
+    """'{http://www.intuit.com/sb/cdm/v2}Name' -> 'Name'"""
+    return tag.rsplit("}", 1)[-1]
+
+# namespaces ElementTree serializes with a fixed prefix (xsi, xs, ..)
+try:
+    from xml.etree.ElementTree import _namespace_map as xml_namespace_map
+except ImportError:
+    xml_namespace_map = {}
+
+def xml_prefixes(element):
+    """
+    The {uri: prefix} map ET.tostring(element) declares: known namespaces
+    get their usual prefix, the rest ns0, ns1, .. in the order they turn up.
+    """
+
+    namespaces = {}
+
+    def add(name):
+        if name[:1] == "{":
+            uri = name[1:].rsplit("}", 1)[0]
+
+            if uri not in namespaces:
+                prefix = xml_namespace_map.get(uri) or \
+                         "ns%d" % len(namespaces)
+
+                if prefix != "xml":
+                    namespaces[uri] = prefix
+
+    for node in element.iter():
+        add(node.tag)
+
+        for key in node.keys():
+            add(key)
+
+    return namespaces
+
+def element_to_dict(element):
+    """
+    Gives the same dict xmltodict.parse(ET.tostring(element)) would (e.g.
+    {"ns0:Customer": {"@xmlns:ns0": .., "ns0:Id": ..}}), without
+    serializing the element and parsing it all over again.
+    """
+
+    namespaces = xml_prefixes(element)
+
+    def qname(name):
+        if name[:1] != "{":
+            return name
+
+        uri, local = name[1:].rsplit("}", 1)
+        prefix = namespaces.get(uri) or xml_namespace_map.get(uri)
+
+        return "%s:%s" % (prefix, local)
+
+    def convert(node, declarations = ()):
+
+        result = collections.OrderedDict(declarations)
+
+        for key, value in sorted(node.items()):
+            result["@" + qname(key)] = value
+
+        for child in node:
+            key = qname(child.tag)
+            value = convert(child)
+
+            if key in result:
+                if not isinstance(result[key], list):
+                    result[key] = [result[key]]
+                result[key].append(value)
+            else:
+                result[key] = value
+
+        #xmltodict keeps all of an element's own character data
+        text = ((node.text or "") + \
+                "".join(child.tail or "" for child in node)).strip()
+
+        if not result:
+            return text or None
+
+        if text:
+            result["#text"] = text
+
+        return result
+
+    declarations = [("@xmlns:" + prefix, uri) for uri, prefix in
+                    sorted(namespaces.items(), key = lambda x: x[1])]
+
+    return collections.OrderedDict([(qname(element.tag),
+                                     convert(element, declarations))])
+
+def iterparse_items(source, item_tags):
+    """
+    Incrementally parses the XML in source (a file-like object, e.g. a
+    streamed response's raw body) and yields (local name, element) for each
+    element whose local name is in item_tags (and that isn't inside another
+    such element). Each one is cleared and dropped from its parent as soon
+    as the next is asked for, so the tree never holds more than the current
+    item: convert it (e.g. with element_to_dict) before moving on.
+    """
+
+    stack = []
+    inside = None
+
+    for event, element in ET.iterparse(source, events=("start", "end")):
+
+        if event == "start":
+            stack.append(element)
+
+            if inside is None and xml_local_name(element.tag) in item_tags:
+                inside = len(stack)
+
+            continue
+
+        stack.pop()
+
+        if inside is not None and len(stack) + 1 == inside:
+            inside = None
+
+            yield xml_local_name(element.tag), element
+
+            element.clear()
+
+            if stack:
+                stack[-1].remove(element)
+
+class MultipartUpload():
+    """
+    A multipart/form-data body for the QBO upload endpoint (an Attachable's
+    json metadata, then the file itself) that reads the file from disk as
+    it's sent, instead of loading it into memory first.
+
+    It's file-like (read, __len__, seek, tell) so requests streams it with
+    a Content-Length, and seek(0) rewinds it for a retry.
+    """
+
+    def __init__(self, metadata, path, filename, content_type,
+                 buffer_size = 64 * 1024):
+
+        self.path = path
+        self.buffer_size = buffer_size
+        self.boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary=%s" % \
+                            self.boundary
+
+        #the head goes out as bytes, so unicode names mustn't make it unicode
+        if isinstance(filename, unicode):
+            filename = filename.encode("utf-8")
+
+        if isinstance(content_type, unicode):
+            content_type = content_type.encode("utf-8")
+
+        self.head = (
+            "--%(b)s\r\n"
+            "Content-Disposition: form-data; name=\"file_metadata_01\"; "
+            "filename=\"attachment.json\"\r\n"
+            "Content-Type: application/json\r\n\r\n"
+            "%(metadata)s\r\n"
+            "--%(b)s\r\n"
+            "Content-Disposition: form-data; name=\"file_content_01\"; "
+            "filename=\"%(filename)s\"\r\n"
+            "Content-Type: %(content_type)s\r\n\r\n") % {
+                "b" : self.boundary, "metadata" : json.dumps(metadata),
+                "filename" : filename.replace('"', "'"),
+                "content_type" : content_type}
+
+        self.tail = "\r\n--%s--\r\n" % self.boundary
+
+        self.file_size = os.path.getsize(path)
+        self.length = len(self.head) + self.file_size + len(self.tail)
+
+        self.f = None
+        self.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def seek(self, offset, whence = 0):
+
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.length
+
+        if offset < 0:
+            raise IOError("Can't seek to before the start of the upload")
+
+        position = offset
+
+        if self.f is None:
+            self.f = open(self.path, "rb")
+
+        #what's left of the head, the file and the tail from there on
+        if offset < len(self.head):
+            self.f.seek(0)
+            self.pending = [self.head[offset:], self.f, self.tail]
+
+        elif offset - len(self.head) < self.file_size:
+            self.f.seek(offset - len(self.head))
+            self.pending = [self.f, self.tail]
+
+        else:
+            offset -= len(self.head) + self.file_size
+            self.pending = [self.tail[offset:]] if offset < len(self.tail) \
+                           else []
+
+        self.position = position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size = -1):
+
+        if size is None or size < 0:
+            size = self.length
+
+        out = []
+        wanted = size
+
+        while wanted > 0 and self.pending:
+            part = self.pending[0]
+
+            if isinstance(part, str):
+                chunk = part[:wanted]
+                rest = part[wanted:]
+
+                if rest:
+                    self.pending[0] = rest
+                else:
+                    self.pending.pop(0)
+
+            else:
+                chunk = part.read(min(wanted, self.buffer_size))
+
+                if not chunk:
+                    self.pending.pop(0)
+                    continue
+
+            out.append(chunk)
+            wanted -= len(chunk)
+
+        data = "".join(out)
+        self.position += len(data)
+
+        return data
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+def utc_timestamp(value):
+    """
+    A QBO timestamp (e.g. MetaData.LastUpdatedTime, "2015-07-24T10:33:39-07:00")
+    as the same moment in UTC, "2015-07-24T17:33:39-00:00", so timestamps
+    from either side of a DST change (or from different realms) sort as
+    strings. Fractions of a second are dropped. Returns value unchanged if
+    it isn't in that format.
+    """
+
+    match = re.match(r"^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?"
+                     r"(Z|([+-])(\d\d):?(\d\d))?$", value or "")
+
+    if match is None:
+        return value
+
+    moment = datetime.datetime.strptime(match.group(1), "%Y-%m-%dT%H:%M:%S")
+
+    if match.group(4) is not None:
+        offset = datetime.timedelta(hours = int(match.group(5)),
+                                    minutes = int(match.group(6)))
+
+        if match.group(4) == "+":
+            moment -= offset
+        else:
+            moment += offset
+
+    return moment.strftime("%Y-%m-%dT%H:%M:%S-00:00")
+
+class EntityStore():
+    """
+    A SQLite-backed copy of the get_objects dicts, so a new process can
+    warm-start from disk instead of downloading every list again.
+
+    Objects are keyed by realm, Business Object type and Id, and stored
+    with their MetaData.LastUpdatedTime (in UTC, see utc_timestamp). Each (realm, type) also keeps the
+    time it was last known to be complete (its cdc watermark).
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS entities (
+                    realm TEXT NOT NULL,
+                    qbbo TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    last_updated TEXT,
+                    body TEXT NOT NULL,
+                    PRIMARY KEY (realm, qbbo, id)
+                );
+                CREATE TABLE IF NOT EXISTS watermarks (
+                    realm TEXT NOT NULL,
+                    qbbo TEXT NOT NULL,
+                    synced_at REAL NOT NULL,
+                    PRIMARY KEY (realm, qbbo)
+                );
+            """)
+
+            #stores written before timestamps were kept in UTC
+            rows = self.connection.execute(
+                "SELECT rowid, last_updated FROM entities " + \
+                "WHERE last_updated NOT LIKE '%-00:00'").fetchall()
+
+            self.connection.executemany(
+                "UPDATE entities SET last_updated = ? WHERE rowid = ?",
+                [(utc_timestamp(value), rowid) for rowid, value in rows])
+
+            self.connection.commit()
+
+    def load(self, realm, qbbo):
+        """Returns the stored objects of this type as a dict keyed by Id."""
+
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, body FROM entities WHERE realm = ? AND qbbo = ?",
+                (str(realm), qbbo)).fetchall()
+
+        object_dict = {}
+
+        for Id, body in rows:
+            object_dict[Id] = default_codec.decode(body)
+
+        return object_dict
+
+    def save(self, realm, qbbo, objects, deleted_ids = [], replace = False,
+             synced_at = None):
+        """
+        Writes objects (and removes deleted_ids) in one transaction. With
+        replace=True everything else stored for this type is dropped first.
+        """
+
+        rows = []
+
+        for o in objects:
+            if isinstance(o, CompactEntity):
+                o = o.to_dict()
+
+            rows.append((str(realm), qbbo, o["Id"],
+                         utc_timestamp(o.get("MetaData",
+                                             {}).get("LastUpdatedTime")),
+                         default_codec.encode(o).decode("utf-8")))
+
+        with self.lock:
+            if replace:
+                self.connection.execute(
+                    "DELETE FROM entities WHERE realm = ? AND qbbo = ?",
+                    (str(realm), qbbo))
+
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?)", rows)
+
+            self.connection.executemany(
+                "DELETE FROM entities WHERE realm = ? AND qbbo = ? AND id = ?",
+                [(str(realm), qbbo, Id) for Id in deleted_ids])
+
+            if synced_at is not None:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?)",
+                    (str(realm), qbbo, synced_at))
+
+            self.connection.commit()
+
+    def last_updated(self, realm, qbbo):
+        """The newest MetaData.LastUpdatedTime stored for this type, in UTC."""
+
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT MAX(last_updated) FROM entities " + \
+                "WHERE realm = ? AND qbbo = ?", (str(realm), qbbo)).fetchone()
+
+        return row[0]
+
+    def synced_at(self, realm, qbbo):
+        """When this type was last known to be complete (or None)."""
+
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT synced_at FROM watermarks WHERE realm = ? AND qbbo = ?",
+                (str(realm), qbbo)).fetchone()
+
+        if row is None:
+            return None
+
+        return row[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class QuickBooks():
+    """A wrapper class around Python's Rauth module for Quickbooks the API"""
+
+    access_token = ''
+    access_token_secret = ''
+    consumer_key = ''
+    consumer_secret = ''
+    company_id = 0
+    callback_url = ''
+    session = None
+    download_session = None
+    store = None
+
+    # a requests HTTPAdapter to share with other clients (see MultiRealmSync)
+    adapter = None
+
+    # every request goes through send_request, over a keep-alive connection
+    # pool of this size, and gives up on a silent server after `timeout`
+    pool_size = 10
+    timeout = 60
+
+    base_url_v3 =  "https://quickbooks.api.intuit.com/v3"
+    base_url_v2 = "https://qbo.intuit.com/qbo1"
+
+    request_token_url = "https://oauth.intuit.com/oauth/v1/get_request_token"
+    access_token_url = "https://oauth.intuit.com/oauth/v1/get_access_token"
+
+    authorize_url = "https://appcenter.intuit.com/Connect/Begin"
+
+    # Intuit allows 500 requests per minute per realm; stay a bit under that
+    requests_per_minute = 450
+    request_burst = 10
+
+    # retries back off exponentially (with jitter) from backoff_base seconds,
+    # up to backoff_cap seconds, unless the server sends a Retry-After
+    backoff_base = 0.5
+    backoff_cap = 30
+
+    # attachment downloads are streamed to disk this many bytes at a time
+    download_buffer_size = 1024 * 1024
+
+    # how long (seconds) and how many flattened reports report() keeps
+    report_cache_ttl = 300
+    report_cache_size = 128
+
+    # keep cached Invoices, Bills, Customers etc. as slotted CompactEntity
+    # objects instead of plain dicts (see Compactor)
+    compact_entities = False
+
+    # encodes every request body and decodes every response (see JsonCodec)
+    codec = default_codec
+
+    # decode query pages from the socket one record at a time by default
+    # (see query_stream)
+    stream_json = False
+    stream_chunk_size = 64 * 1024
+
+    # QBO's cdc only looks back 30 days, and caps each type at 1000 objects
+    cdc_window = 30 * 24 * 60 * 60
+    cdc_max_results = 1000
+
+    # Things needed for authentication
+    qbService = None
+
+    request_token = ''
+    request_token_secret = ''
+
+    def __init__(self, **args):
+
+        if 'cred_path' in args:
+            self.read_creds_from_file(args['cred_path'])
+
+        if 'consumer_key' in args:
+            self.consumer_key = args['consumer_key']
+
+        if 'consumer_secret' in args:
+            self.consumer_secret = args['consumer_secret']
+
+        if 'access_token' in args:
+            self.access_token = args['access_token']
+
+        if 'access_token_secret' in args:
+            self.access_token_secret = args['access_token_secret']
+
+        if 'company_id' in args:
+            self.company_id = args['company_id']
+
+        if 'callback_url' in args:
+            self.callback_url = args['callback_url']
+
+        if 'adapter' in args:
+            self.adapter = args['adapter']
+
+        if 'base_url_v3' in args:
+            #e.g. a sandbox, or a local stub server for testing
+            self.base_url_v3 = args['base_url_v3']
+
+        if 'store' in args:
+            #either an EntityStore or the path to its SQLite file
+            if isinstance(args['store'], basestring):
+                self.store = EntityStore(args['store'])
+            else:
+                self.store = args['store']
+
+        if 'verbose' in args:
+            self.verbose = True
+        else:
+            self.verbose = False
+
+        if 'verbosity' in args:
+            self.verbosity = args['verbosity']
+        else:
+            self.verbosity = 0
+
+        self._BUSINESS_OBJECTS = [
+
+            "Account","Attachable","Bill","BillPayment",
+            "Class","CompanyInfo","CreditMemo","Customer",
+            "Department","Employee","Estimate","Invoice",
+            "Item","JournalEntry","Payment","PaymentMethod",
+            "Preferences","Purchase","PurchaseOrder",
+            "SalesReceipt","TaxCode","TaxRate","Term",
+            "TimeActivity","Vendor","VendorCredit"
+
+        ]
+
+        self._NAME_LIST_OBJECTS = [
+
+            "Account", "Class", "Customer", "Department", "Employee", "Item",
+            "PaymentMethod", "TaxCode", "TaxRate", "Term", "Vendor"
+
+        ]
+
+        self._TRANSACTION_OBJECTS = [
+
+            "Bill", "BillPayment", "CreditMemo", "Estimate", "Invoice",
+            "JournalEntry", "Payment", "Purchase", "PurchaseOrder",
+            "SalesReceipt", "TimeActivity", "VendorCredit"
+
+        ]
+
+        #{qbbo: epoch seconds}, when each <qbbo>s dict was last known to be
+        #complete, so it can be brought up to date through change data capture
+        self.cdc_watermarks = {}
+
+        #built on demand by build_ref_index, then kept current with the caches
+        self.ref_index = None
+
+        if 'compact_entities' in args:
+            self.compact_entities = args['compact_entities']
+
+        #called with a dict for every request (see new_request_metrics),
+        #e.g. a shared RequestMetrics's record
+        self.metrics_callbacks = list(args.get('metrics_callbacks', []))
+
+        self.compactor = Compactor()
+
+        self.report_cache = ReportCache(self.report_cache_size,
+                                        self.report_cache_ttl)
+
+        #so concurrent workers don't each create their own session
+        self.session_lock = threading.Lock()
+
+
+    def get_authorize_url(self):
+        """Returns the Authorize URL as returned by QB,
+        and specified by OAuth 1.0a.
+        :return URI:
+        """
+        self.qbService = OAuth1Service(
+                name = None,
+                consumer_key = self.consumer_key,
+                consumer_secret = self.consumer_secret,
+                request_token_url = self.request_token_url,
+                access_token_url = self.access_token_url,
+                authorize_url = self.authorize_url,
+                base_url = None
+            )
+
+        rt, rts = self.qbService.get_request_token(
+            params={'oauth_callback':self.callback_url}
+        )
+
+        self.request_token, self.request_token_secret = [rt, rts]
+
+        return self.qbService.get_authorize_url(self.request_token)
+
+    def get_access_tokens(self, oauth_verifier):
+        """Wrapper around get_auth_session, returns session, and sets
+        access_token and access_token_secret on the QB Object.
+        :param oauth_verifier: the oauth_verifier as specified by OAuth 1.0a
+        """
+        session = self.qbService.get_auth_session(
+                self.request_token,
+                self.request_token_secret,
+                data={'oauth_verifier': oauth_verifier})
+
+        self.access_token = session.access_token
+        self.access_token_secret = session.access_token_secret
+
+        return session
+
+    def create_session(self):
+        if self.consumer_secret and self.consumer_key and \
+           self.access_token_secret and self.access_token:
+            self.session = OAuth1Session(self.consumer_key,
+                                         self.consumer_secret,
+                                         self.access_token,
+                                         self.access_token_secret)
+
+            self.mount_pool(self.session)
+
+        else:
+
+            # shouldn't there be a workflow somewhere to GET the auth tokens?
+
+            # add that or ask someone on oDesk to build it...
+
+            raise Exception("Need four creds for Quickbooks.create_session.")
+
+        return self.session
+
+    def mount_pool(self, session):
+        """
+        Gives a requests session a keep-alive connection pool of pool_size
+        (or the shared adapter, if there is one) and asks for compressed
+        responses.
+        """
+
+        adapter = self.adapter
+
+        if adapter is None:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        session.headers.update({"Accept-Encoding" : "gzip, deflate",
+                                "Connection" : "keep-alive"})
+
+        return session
+
+    def get_session(self):
+        """Returns the OAuth session, creating it the first time round."""
+
+        if self.session is None:
+            with self.session_lock:
+                if self.session is None:
+                    self.create_session()
+
+        return self.session
+
+    def get_download_session(self):
+        """
+        A plain pooled session for file links, which are already signed and
+        mustn't get OAuth headers added.
+        """
+
+        if self.download_session is None:
+            with self.session_lock:
+                if self.download_session is None:
+                    self.download_session = self.mount_pool(requests.Session())
+
+        return self.download_session
+
+    def send_request(self, request_type, url, headers = None, data = None,
+                     realm = None, metrics = None, **req_kwargs):
+        """
+        The one place requests to Intuit actually go out: signs them with the
+        pooled OAuth session, waits on the realm's rate limiter and applies
+        the default timeout. Retrying is up to the caller (see hammer_it
+        and keep_trying).
+
+        If given a metrics dict (from new_request_metrics), the attempt, its
+        latency, time spent throttled, status and response size are added
+        to it. (A streamed response's size is its Content-Length, if any.)
+        """
+
+        session = self.get_session()
+
+        if realm is None:
+            realm = self.company_id
+
+        req_kwargs.setdefault("timeout", self.timeout)
+
+        waited = time.time()
+
+        self.throttle()
+
+        sent = time.time()
+
+        try:
+            response = session.request(request_type, url, True, realm,
+                                       headers = headers, data = data,
+                                       **req_kwargs)
+        finally:
+            if metrics is not None:
+                metrics["attempts"] += 1
+                metrics["throttle_wait"] += sent - waited
+                metrics["latency"] += time.time() - sent
+
+        if metrics is not None:
+            metrics["status"] = response.status_code
+
+            if req_kwargs.get("stream"):
+                metrics["bytes"] += int(response.headers.get(
+                    "Content-Length") or 0)
+            else:
+                metrics["bytes"] += len(response.content)
+
+        return response
+
+    def new_request_metrics(self, request_type, url, payload = None,
+                            realm = None, params = None):
+        """
+        The dict that send_request and its callers fill in for one logical
+        request (every retry included), and that record_request then hands
+        to each of metrics_callbacks. Times are in seconds:
+
+        realm, entity, operation  what it was for (operation being read,
+                                  write, delete, query, batch, cdc, report,
+                                  upload, download or v2)
+        attempts, retries         how many tries it took
+        latency, throttle_wait    waiting on Intuit / on the rate limiter
+        bytes, decode_time        response size and time spent decoding
+        status, fault             last HTTP status and final Fault type (or
+                                  exception name), None if it worked
+        """
+
+        entity = None
+        path = url.split("?")[0]
+
+        if "/resource/" in path:
+            #v2, e.g. /resource/customers/v2/<realm>
+            entity = path.split("/resource/")[1].split("/")[0]
+            operation = "v2"
+
+        else:
+            parts = path.split("/company/", 1)[-1].split("/")[1:]
+            segment = parts[0] if parts else ""
+
+            if segment == "query":
+                match = re.search(r"(?i)\bFROM\s+(\w+)",
+                                  payload if isinstance(payload, basestring)
+                                  else "")
+                entity = match.group(1) if match else None
+                operation = "query"
+
+            elif segment == "reports":
+                entity = parts[1] if len(parts) > 1 else None
+                operation = "report"
+
+            elif segment in ["batch", "cdc", "upload", "download"]:
+                operation = segment
+
+            else:
+                entity = segment
+
+                for qbbo in self._BUSINESS_OBJECTS:
+                    if qbbo.lower() == segment:
+                        entity = qbbo
+
+                if "operation=delete" in url or \
+                   (params or {}).get("operation") == "delete":
+                    operation = "delete"
+                elif request_type == "GET":
+                    operation = "read"
+                else:
+                    operation = "write"
+
+        return {
+            "realm" : str(realm if realm is not None else self.company_id),
+            "entity" : entity,
+            "operation" : operation,
+            "attempts" : 0,
+            "retries" : 0,
+            "latency" : 0.0,
+            "throttle_wait" : 0.0,
+            "bytes" : 0,
+            "decode_time" : 0.0,
+            "status" : None,
+            "fault" : None,
+        }
+
+    def record_request(self, metrics, fault = None):
+        """
+        Finishes off a new_request_metrics dict and passes it to every one of
+        metrics_callbacks. A callback that fails can't break the request.
+        """
+
+        metrics["retries"] = max(metrics["attempts"] - 1, 0)
+
+        if fault is not None:
+            metrics["fault"] = fault
+
+        for callback in self.metrics_callbacks:
+            try:
+                callback(metrics)
+            except Exception as e:
+                if self.verbose:
+                    print "Metrics callback failed: %s" % e
+
+    def query_count(self, original_payload):
+        """
+        Turns a SELECT query into a SELECT COUNT(*) query and returns the
+        totalCount QBO reports for it (or None if it didn't give us one).
+        """
+
+        count_payload = re.sub(r"(?is)^\s*SELECT\s+.*?\s+FROM\s+",
+                               "SELECT COUNT(*) FROM ", original_payload, 1)
+
+        #ORDERBY isn't allowed (and is pointless) on a count query
+        count_payload = re.split(r"(?i)\s+ORDER\s*BY\s+", count_payload)[0]
+
+        url = self.base_url_v3 + "/company/%s/query" % self.company_id
+
+        r_dict = self.keep_trying("POST", url, True, self.company_id,
+                                  count_payload)
+
+        try:
+            return int(r_dict['QueryResponse']['totalCount'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def query_fetch_page(self, r_type, qb_object, original_payload,
+                         start_position, max_results = 500):
+        """
+        Fetches a single STARTPOSITION/MAXRESULTS page of a query and returns
+        the list of objects in it (an empty list if there aren't any). A page
+        that's still faulting after a retry raises, rather than coming back
+        empty and passing for the end of the results.
+        """
+
+        url = self.base_url_v3 + "/company/%s/query" % self.company_id
+
+        if start_position <= 1:
+            payload = "%s MAXRESULTS %s" % (original_payload, max_results)
+        else:
+            payload = "%s STARTPOSITION %s MAXRESULTS %s" % (original_payload,
+                    start_position, max_results)
+
+        r_dict = self.keep_trying(r_type, url, True, self.company_id, payload)
+
+        if 'QueryResponse' in r_dict and qb_object in r_dict['QueryResponse']:
+            return r_dict['QueryResponse'][qb_object]
+
+        if not ('QueryResponse' in r_dict and r_dict['QueryResponse'] == {}):
+            print "FAILED", r_dict
+            r_dict = self.keep_trying(r_type, url, True, self.company_id,
+                                      payload)
+
+        if 'QueryResponse' in r_dict and qb_object in r_dict['QueryResponse']:
+            return r_dict['QueryResponse'][qb_object]
+
+        if 'QueryResponse' in r_dict and r_dict['QueryResponse'] == {}:
+            return []
+
+        raise Exception("Query page at %s failed: %s" % (start_position,
+                                                         r_dict))
+
+    def query_stream(self, qb_object, payload):
+        """
+        Runs one query request and yields its records straight off the wire
+        (see iter_json_array), instead of decoding the whole body at once.
+        Failures before the first record are retried like keep_trying does.
+        """
+
+        url = self.base_url_v3 + "/company/%s/query" % self.company_id
+
+        headers = {
+            'Content-Type': 'application/text',
+            'Accept': 'application/json'
+        }
+
+        tries = 0
+        r = None
+
+        metrics = self.new_request_metrics("POST", url, payload)
+
+        while True:
+            tries += 1
+
+            if tries > 1:
+                self.backoff(tries, r)
+
+            yielded = 0
+
+            try:
+                r = self.send_request("POST", url, headers, payload,
+                                      stream = True, metrics = metrics)
+
+                #decode_time here includes reading the body off the socket
+                for record in timed_iter(iter_json_array(
+                        r.iter_content(self.stream_chunk_size), qb_object),
+                                         metrics):
+                    yielded += 1
+                    yield record
+
+                self.record_request(metrics)
+
+                return
+
+            except Exception as e:
+
+                #once records have gone out we can't start the page over
+                if yielded > 0 or tries > 10:
+                    self.record_request(metrics, type(e).__name__)
+                    raise
+
+                if self.verbose:
+                    print "(streamed query failed: %s)" % e
+
+            finally:
+                if r is not None:
+                    r.close()
+
+    def query_fetch_concurrent(self, r_type, qb_object, original_payload,
+                               max_results = 500, max_workers = 4):
+        """
+        Plans the number of pages up front with a COUNT(*) query, then
+        fetches them all on a bounded pool of worker threads. Pages are
+        stitched back together in order, so the result matches what the
+        sequential query_fetch_more gives you.
+        """
+
+        total = self.query_count(original_payload)
+
+        if total is None:
+            #can't plan without a count, so fall back to walking the pages
+            return self.query_fetch_more(r_type, True, self.company_id,
+                                         qb_object, original_payload)
+
+        if total == 0:
+            return []
+
+        page_count = (total + max_results - 1) // max_results
+
+        if self.verbose:
+            print "Fetching %d %ss in %d pages (%d workers)" % \
+                (total, qb_object, page_count, max_workers)
+
+        args_list = [(r_type, qb_object, original_payload,
+                      1 + page * max_results, max_results)
+                     for page in range(page_count)]
+
+        pages = run_in_pool(self.query_fetch_page, args_list, max_workers)
+
+        data_set = []
+
+        for page in pages:
+            data_set += page
+
+        #records created while we were fetching would land past the count
+        if len(pages[-1]) == max_results:
+            start_position = 1 + page_count * max_results
+
+            while True:
+                page = self.query_fetch_page(r_type, qb_object,
+                                             original_payload,
+                                             start_position, max_results)
+                data_set += page
+
+                if len(page) < max_results:
+                    break
+
+                start_position += max_results
+
+        return data_set
+
+    def query_fetch_more(self, r_type, header_auth, realm,
+                         qb_object, original_payload ='',
+                         concurrent = False, max_workers = 4, keyset = None):
+        """ Wrapper script around keep_trying to fetch more results if
+        there are more.
+
+        Pass concurrent=True to fetch the pages on a pool of max_workers
+        threads instead of one after another (see query_fetch_concurrent),
+        or keyset="Id"/"MetaData.LastUpdatedTime" to page by key instead of
+        by offset (see iter_query_keyset).
+        """
+
+        # 500 is the maximum number of results returned by QB
+
+        max_results = 500
+
+        if keyset is not None:
+            return list(self.iter_query_keyset(qb_object, original_payload,
+                                               keyset, False, max_results))
+
+        if concurrent:
+            return self.query_fetch_concurrent(r_type, qb_object,
+                                               original_payload,
+                                               max_results, max_workers)
+        start_position = 0
+        more = True
+        data_set = []
+        url = self.base_url_v3 + "/company/%s/query" % self.company_id
+
+        # Edit the payload to return more results.
+
+        payload = original_payload + " MAXRESULTS " + str(max_results)
+
+        while more:
+
+            r_dict = self.keep_trying(r_type, url, True, self.company_id, payload)
+
+            try:
+                access = r_dict['QueryResponse'][qb_object]
+            except:
+                if 'QueryResponse' in r_dict and r_dict['QueryResponse'] == {}:
+                    #print "Query OK, no results: %s" % r_dict['QueryResponse']
+                    return []
+                else:
+                    print "FAILED", r_dict
+                    r_dict = self.keep_trying(r_type,
+                                              url,
+                                              True,
+                                              self.company_id,
+                                              payload)
+
+            # For some reason the totalCount isn't returned for some queries,
+            # in that case, check the length, even though that actually requires
+            # measuring
+            try:
+                result_count = int(r_dict['QueryResponse']['totalCount'])
+                if result_count < max_results:
+                    more = False
+            except KeyError:
+                try:
+                    result_count = len(r_dict['QueryResponse'][qb_object])
+                    if result_count < max_results:
+                        more = False
+                except KeyError:
+                    print "\n\n ERROR", r_dict
+                    pass
+
+
+            if self.verbose:
+
+                print "(batch begins with record %d)" % start_position
+
+
+            # Just some math to prepare for the next iteration
+            if start_position == 0:
+                start_position = 1
+
+            start_position = start_position + max_results
+            payload = "%s STARTPOSITION %s MAXRESULTS %s" % (original_payload,
+                    start_position, max_results)
+
+            data_set += r_dict['QueryResponse'][qb_object]
+
+        #print "Records Found: %d." % len(data_set)
+        return data_set
+
+    def create_object(self, qbbo, request_body, content_type = "json"):
+        """
+        One of the four glorious CRUD functions.
+        Getting this right means using the correct object template and
+        and formulating a valid request_body. This doesn't help with that.
+        It just submits the request and adds the newly-created object to the
+        session's brain.
+        """
+
+        if qbbo not in self._BUSINESS_OBJECTS:
+            raise Exception("%s is not a valid QBO Business Object." % qbbo,
+                            " (Note that this validation is case sensitive.)")
+
+        url = self.base_url_v3 + "/company/%s/%s" % \
+              (self.company_id, qbbo.lower())
+
+        if isinstance(request_body, dict) and content_type == "json":
+            request_body = self.codec.encode(request_body)
+
+        if self.verbose:
+
+            print "About to create a(n) %s object with this request_body:" \
+                % qbbo
+            print request_body
+
+        response = self.hammer_it("POST", url, request_body, content_type)
+
+        if qbbo in response:
+
+            new_object = response[qbbo]
+
+        else:
+
+            print "It looks like the create failed. Here's the result:"
+            print response
+
+            return None
+
+        self.cache_object(qbbo, new_object)
+
+        return new_object
+
+    def cache_object(self, qbbo, new_object):
+        """
+        Adds (or replaces) an object in the session's <qbbo>s dict, creating
+        that dict first if we haven't cached this type yet.
+        """
+
+        new_Id     = new_object["Id"]
+
+        attr_name = qbbo+"s"
+
+        if not hasattr(self,attr_name):
+
+            if self.verbose:
+                print "Creating a %ss attribute for this session." % qbbo
+
+            self.get_objects(qbbo).update(
+                {new_Id:self.prepare_object(qbbo, new_object)})
+
+        else:
+
+            if self.verbose:
+                print "Adding this new %s to the existing set of them." \
+                    % qbbo
+                print json.dumps(new_object, indent=4)
+
+            getattr(self, attr_name)[new_Id] = self.prepare_object(qbbo,
+                                                                   new_object)
+
+        self.objects_changed(qbbo, [new_object])
+
+    def prepare_object(self, qbbo, o):
+        """What actually goes into the <qbbo>s dict for o: o itself, or its
+        CompactEntity if compact_entities is on."""
+
+        if self.compact_entities:
+            return self.compactor.compact(qbbo, o)
+
+        return o
+
+    def uncache_object(self, qbbo, object_id):
+        """Drops an object from the session's <qbbo>s dict, if it's there."""
+
+        attr_name = qbbo+"s"
+
+        if hasattr(self, attr_name):
+            getattr(self, attr_name).pop(object_id, None)
+
+        self.objects_changed(qbbo, [], [object_id])
+
+    def objects_changed(self, qbbo, objects, deleted_ids = [], replace = False,
+                        synced_at = None):
+        """
+        Called whenever a <qbbo>s dict changes, to keep the store and the
+        reference index in step with it.
+        """
+
+        if self.store is not None:
+            self.store.save(self.company_id, qbbo, objects, deleted_ids,
+                            replace, synced_at)
+
+        if self.ref_index is not None and qbbo in self._TRANSACTION_OBJECTS:
+            self.ref_index.update(qbbo, objects, deleted_ids, replace)
+
+    def build_ref_index(self, qbbo_list = None):
+        """
+        Indexes the cached transactions (all types by default, fetching any
+        that aren't cached yet) by the refs on their headers and lines. From
+        then on the index follows every change to the caches.
+        """
+
+        if qbbo_list is None:
+            qbbo_list = self._TRANSACTION_OBJECTS
+
+        if self.ref_index is None:
+            self.ref_index = RefIndex()
+
+        for qbbo in qbbo_list:
+            self.ref_index.update(qbbo, self.get_objects(qbbo).values(),
+                                  replace = True)
+
+        return self.ref_index
+
+    def find_transactions(self, ref_type, ref_id, qbbo_list = None):
+        """
+        Looks up every cached transaction that references ref_id through a
+        ref_type ("CustomerRef", "ClassRef", "AccountRef", "ItemRef" or
+        "DepartmentRef"), without scanning or refetching anything.
+
+        Returns a list of (qbbo, transaction, line positions) tuples, with
+        any cached CompactEntity handed out as a dict (see to_dict).
+        """
+
+        if qbbo_list is None:
+            qbbo_list = self._TRANSACTION_OBJECTS
+
+        if self.ref_index is None:
+            self.build_ref_index(qbbo_list)
+        else:
+            missing = [qbbo for qbbo in qbbo_list
+                       if qbbo not in self.ref_index.qbbos]
+
+            if len(missing) > 0:
+                self.build_ref_index(missing)
+
+        found = []
+
+        for (qbbo, Id), positions in \
+            sorted(self.ref_index.lookup(ref_type, ref_id, qbbo_list).items()):
+
+            transaction = getattr(self, qbbo+"s").get(Id)
+
+            if isinstance(transaction, CompactEntity):
+                transaction = transaction.to_dict()
+
+            if transaction is not None:
+                found.append((qbbo, transaction, positions))
+
+        return found
+
+    def find_transactions_for_class(self, qbbo, class_name):
+        """
+        The indexed equivalent of the fetch_bills / fetch_journal_entries
+        class filter: transactions with a line in any class whose name
+        contains class_name.
+        """
+
+        found = []
+        seen = set()
+
+        for Id, klass in self.get_objects("Class").items():
+
+            name = klass.get("FullyQualifiedName", klass.get("Name", ""))
+
+            if class_name not in name:
+                continue
+
+            for q, transaction, positions in \
+                self.find_transactions("ClassRef", Id, [qbbo]):
+
+                if transaction["Id"] not in seen:
+                    seen.add(transaction["Id"])
+                    found.append(transaction)
+
+        return found
+
+    def batch_objects(self, operations, content_type = "json",
+                      batch_size = 30):
+        """
+        Sends many create/update/delete operations through the QBO batch
+        endpoint, batch_size (at most 30) at a time.
+
+        operations is a list of (operation, qbbo, request_body) tuples, where
+        request_body is a dict or a json string, e.g.
+            [("create", "Invoice", {...}), ("delete", "Bill", {...})]
+
+        Returns a list with one entry per operation, in the same order:
+        the resulting object, or a {"Fault": {...}} dict if that item failed.
+        The session's <qbbo>s dicts are kept up to date as well.
+        """
+
+        url = self.base_url_v3 + "/company/%s/batch" % \
+              self.company_id
+
+        batch_size = min(batch_size, 30)
+
+        results = []
+
+        for start in range(0, len(operations), batch_size):
+
+            chunk = operations[start:start+batch_size]
+
+            items = []
+
+            for i, (operation, qbbo, request_body) in enumerate(chunk):
+
+                if qbbo not in self._BUSINESS_OBJECTS:
+                    raise Exception("%s is not a valid QBO Business Object." \
+                                    % qbbo, " (Note that this validation " + \
+                                    "is case sensitive.)")
+
+                if isinstance(request_body, basestring):
+                    request_body = self.codec.decode(request_body)
+
+                items.append({"bId" : str(i),
+                              "operation" : operation,
+                              qbbo : request_body})
+
+            if self.verbose:
+                print "Sending a batch of %d operations." % len(items)
+
+            response = self.hammer_it("POST", url,
+                                      self.codec.encode(
+                                          {"BatchItemRequest":items}),
+                                      content_type)
+
+            by_bId = {}
+
+            for item in response.get("BatchItemResponse", []):
+                by_bId[item.get("bId")] = item
+
+            for i, (operation, qbbo, request_body) in enumerate(chunk):
+
+                item = by_bId.get(str(i))
+
+                if item is None:
+                    #the whole batch failed, so this one did too
+                    results.append({"Fault" : response.get("Fault",
+                                    {"type":"(inconclusive)"})})
+
+                elif qbbo in item:
+                    new_object = item[qbbo]
+
+                    #only touch caches we already have (as update_object
+                    #does), rather than download every type in the batch
+                    if hasattr(self, qbbo+"s"):
+
+                        if operation == "delete":
+                            self.uncache_object(qbbo, new_object["Id"])
+                        else:
+                            self.cache_object(qbbo, new_object)
+
+                    results.append(new_object)
+
+                else:
+                    if self.verbose:
+                        print "Batch item %s (%s %s) failed:" % \
+                            (start + i, operation, qbbo)
+                        print item
+
+                    results.append({"Fault" : item.get("Fault", item)})
+
+        return results
+
+    def read_object(self, qbbo, object_id, content_type = "json"):
+        """Makes things easier for an update because you just do a read,
+        tweak the things you want to change, and send that as the update
+        request body (instead of having to create one from scratch)."""
+
+        url = self.base_url_v3 + "/company/%s/%s/%s" % \
+              (self.company_id, qbbo.lower(), object_id)
+
+        response = self.hammer_it("GET", url, None, content_type)
+
+        if not qbbo in response:
+
+            return response
+
+        #otherwise we don't need the time (and outer shell)
+
+        return response[qbbo]
+
+    def update_object(self, qbbo, Id, update_dict, content_type = "json",
+                      sparse = True):
+        """
+        update_dict (a dict or json string) only needs the fields you want
+        to change. By default that's sent as a QBO sparse update along with
+        the Id and SyncToken, so there's no need to read the object first:
+        the SyncToken comes from update_dict, or the cached <qbbo>s dict, or
+        (only if neither has it) a single read. If the token turns out to be
+        stale, the object is re-read once and the update retried.
+
+        With sparse=False the whole object is read, merged with update_dict
+        and sent back, the way QBO full updates work.
+        """
+
+        if qbbo not in self._BUSINESS_OBJECTS:
+            raise Exception("%s is not a valid QBO Business Object." % qbbo,
+                            " (Note that this validation is case sensitive.)")
+
+        """
+        url = "https://qb.sbfinance.intuit.com/v3/company/%s/%s" % \
+              (self.company_id, qbbo.lower()) + "?operation=update"
+
+        url = "https://quickbooks.api.intuit.com/v3/company/%s/%s" % \
+              (self.company_id, qbbo.lower()) + "?requestid=%s" % Id
+        """
+
+        #see this link for url troubleshooting info:
+        #http://stackoverflow.com/questions/23333300/whats-the-correct-uri-
+        # for-qbo-v3-api-update-operation/23340464#23340464
+
+        url = self.base_url_v3 + "/company/%s/%s" % \
+              (self.company_id, qbbo.lower())
+
+        if isinstance(update_dict, basestring):
+            udd = self.codec.decode(update_dict)
+        else:
+            udd = dict(update_dict)
+
+        #the caches are keyed by string Ids
+        Id = str(Id)
+
+        cached = getattr(self, qbbo+"s", {}).get(Id)
+
+        if sparse:
+
+            e_dict = {"Id" : Id, "sparse" : True}
+
+            if "SyncToken" in udd:
+                e_dict["SyncToken"] = udd["SyncToken"]
+            elif cached is not None and "SyncToken" in cached:
+                e_dict["SyncToken"] = cached["SyncToken"]
+            else:
+                e_dict["SyncToken"] = self.read_object(qbbo, Id)["SyncToken"]
+
+        else:
+
+            #work from the existing json dictionary
+            e_dict = self.read_object(qbbo, Id)
+
+        e_dict.update(udd)
+
+        for attempt in [1, 2]:
+
+            request_body = self.codec.encode(e_dict)
+
+            if self.verbose:
+
+                print "About to update %s Id %s with this request_body:" \
+                    % (qbbo, Id)
+
+                print request_body
+
+            response = self.hammer_it("POST", url, request_body, content_type)
+
+            if attempt == 1 and self.is_stale_object_fault(response):
+
+                if self.verbose:
+                    print "Stale SyncToken for %s %s; re-reading it." % \
+                        (qbbo, Id)
+
+                e_dict["SyncToken"] = self.read_object(qbbo, Id)["SyncToken"]
+
+            else:
+                break
+
+        if qbbo in response:
+
+            new_object = response[qbbo]
+
+        else:
+
+            print "It looks like the update failed. Here's the result:"
+            print response
+
+            return None
+
+        #only touch a cache we already have (rather than download the lot)
+        if hasattr(self, qbbo+"s"):
+            self.cache_object(qbbo, new_object)
+
+        return new_object
+
+    def is_stale_object_fault(self, response):
+        """True if QBO rejected a write because the SyncToken was out of date
+        (error 5010, "Stale Object Error")."""
+
+        if "Fault" not in response:
+            return False
+
+        for error in response["Fault"].get("Error", []):
+            if str(error.get("code")) == "5010":
+                return True
+
+        return False
+
+    def delete_object(self, qbbo, object_id, content_type = "json"):
+        """Deletes by Id. QBO only needs the Id and SyncToken, so that's all
+        that gets sent; the SyncToken comes from the cached <qbbo>s dict if
+        it's there (otherwise from a read). A stale token gets one re-read
+        and retry. The object is then dropped from the caches."""
+
+        #the caches are keyed by string Ids
+        object_id = str(object_id)
+
+        cached = getattr(self, qbbo+"s", {}).get(object_id)
+
+        if cached is not None and "SyncToken" in cached:
+            sync_token = cached["SyncToken"]
+        else:
+            json_dict = self.read_object(qbbo, object_id)
+
+            if not 'Id' in json_dict:
+
+                return "NO OBJECT FOUND"
+
+            sync_token = json_dict["SyncToken"]
+
+        url = self.base_url_v3 + "/company/%s/%s" % \
+              (self.company_id, qbbo.lower())
+
+        for attempt in [1, 2]:
+
+            request_body = self.codec.encode({"Id" : object_id,
+                                              "SyncToken" : sync_token})
+
+            response = self.hammer_it("POST", url, request_body, content_type,
+                                      **{"params":{"operation":"delete"}})
+
+            if attempt == 1 and self.is_stale_object_fault(response):
+
+                json_dict = self.read_object(qbbo, object_id)
+
+                if not 'Id' in json_dict:
+
+                    return "NO OBJECT FOUND"
+
+                sync_token = json_dict["SyncToken"]
+
+            else:
+                break
+
+        if not qbbo in response:
+
+            return response
+
+        self.uncache_object(qbbo, object_id)
+
+        return response[qbbo]
+
+    def delete_objects(self, qbbo, object_ids, content_type = "json"):
+        """
+        Bulk delete_object: deletes through the batch endpoint, 30 at a
+        time, with minimal Id/SyncToken bodies (tokens from the cache where
+        possible, read otherwise). Items that fail on a stale token are
+        re-read and retried once.
+
+        Returns a list with the result (or {"Fault": ...}) for each Id.
+        """
+
+        cache = getattr(self, qbbo+"s", {})
+
+        #the caches are keyed by string Ids
+        object_ids = [str(object_id) for object_id in object_ids]
+
+        def sync_token(object_id, use_cache = True):
+            cached = cache.get(object_id)
+
+            if use_cache and cached is not None and "SyncToken" in cached:
+                return cached["SyncToken"]
+
+            return self.read_object(qbbo, object_id).get("SyncToken")
+
+        results = self.batch_objects(
+            [("delete", qbbo, {"Id" : object_id,
+                               "SyncToken" : sync_token(object_id)})
+             for object_id in object_ids], content_type)
+
+        stale = [i for i, result in enumerate(results)
+                 if self.is_stale_object_fault(result)]
+
+        if len(stale) > 0:
+
+            if self.verbose:
+                print "Retrying %d deletes with stale SyncTokens." % len(stale)
+
+            retried = self.batch_objects(
+                [("delete", qbbo,
+                  {"Id" : object_ids[i],
+                   "SyncToken" : sync_token(object_ids[i], False)})
+                 for i in stale], content_type)
+
+            for i, result in zip(stale, retried):
+                results[i] = result
+
+        return results
+
+    def upload_file(self, path, name = "same", upload_type = "automatic",
+                    qbbo = None, Id = None):
+        """
+        Uploads a file that can be linked to a specific transaction (or other
+         entity probably), or not...
+
+        The file is streamed from disk (see MultipartUpload) rather than read
+         into memory. upload_type is the file's content type, guessed from
+         its extension by default, and name replaces the file's bare name.
+
+        Either way, it returns the Id of the new Attachable.
+        """
+
+        url = self.base_url_v3 + "/company/%s/upload" % \
+              self.company_id
+
+        filename         = os.path.basename(path)
+
+        bare_name, extension = os.path.splitext(filename)
+
+        if upload_type == "automatic":
+
+            upload_type = mimetypes.guess_type(filename)[0] or \
+                          "application/%s" % (extension[1:] or "octet-stream")
+
+        if not name == "same":
+
+            filename = name + extension
+
+        metadata = {
+            "FileName"    : filename,
+            "ContentType" : upload_type,
+        }
+
+        if qbbo is not None and Id is not None:
+
+            metadata["AttachableRef"] = [{
+
+                "EntityRef" : {"type" : qbbo, "value" : str(Id)}
+
+            }]
+
+        body = MultipartUpload(metadata, path, filename, upload_type)
+
+        try:
+            result = self.hammer_it("POST", url, None, "json", files=body)
+        finally:
+            body.close()
+
+        try:
+            attachable = result["AttachableResponse"][0]["Attachable"]
+        except (KeyError, IndexError, TypeError):
+            raise Exception("Upload of %s failed: %s" % (path, result))
+
+        attachment_id = attachable["Id"]
+
+        return attachment_id
+
+    def upload_files(self, uploads, max_workers = 4):
+        """
+        Uploads many files at once (each one streamed from disk, and all of
+        them going through the realm's rate limiter). uploads is a list of
+        paths, or of (path, qbbo, Id) tuples to link each new Attachable to
+        that entity, e.g. ("scans/1042.pdf", "Bill", 1042).
+
+        Returns a list of {"path", "Id", "error"} dicts in the same order,
+        Id being the new Attachable's (None if that upload failed).
+        """
+
+        def upload(item):
+
+            if isinstance(item, basestring):
+                item = (item, None, None)
+
+            path, qbbo, Id = item
+
+            result = {"path" : path, "Id" : None, "error" : None}
+
+            try:
+                result["Id"] = self.upload_file(path, qbbo = qbbo, Id = Id)
+            except Exception as e:
+                result["error"] = e
+
+            return result
+
+        return run_in_pool(upload, [(item,) for item in uploads],
+                           max_workers)
+
+    def download_file(self, attachment_id, destination_path=""):
+        """
+        Download a file to the requested (or default) directory, then also
+         return a download link for convenience.
+        """
+        url = self.base_url_v3 + "/company/%s/download/%s" % \
+              (self.company_id, attachment_id)
+
+        # Custom accept for file link!
+        link =  self.hammer_it("GET", url, None, "json", accept="filelink")
+
+        # The file's name is in the url the link redirects to
+        self.stream_to_file(link, lambda final_url: destination_path + \
+                            final_url.split("%2F")[2].split("?")[0])
+
+        return link
+
+    def stream_to_file(self, link, path, resolve_link = None):
+        """
+        Streams a file link to path through the pooled download session,
+        download_buffer_size bytes at a time. It's written to path + ".part"
+        first, and a partial file left over from a dropped connection (this
+        time or last) is resumed with an HTTP Range request. If the link has
+        expired, resolve_link() is called for a fresh one.
+
+        path can also be a function of the url the link ends up at (after
+        redirects), for files that are named there.
+
+        Dropped connections, timeouts and 5xx responses are retried; any
+        other error status is raised straight away.
+
+        Returns the number of bytes in the finished file.
+        """
+
+        if callable(path):
+            #not known until we've been redirected
+            name_path = path
+            path = partial = None
+        else:
+            name_path = None
+            partial = path + ".part"
+
+        tries = 0
+
+        #links point off to storage, so say what this was for
+        metrics = self.new_request_metrics("GET", link)
+        metrics["entity"] = None
+        metrics["operation"] = "download"
+
+        while True:
+            tries += 1
+
+            have = os.path.getsize(partial) \
+                   if partial is not None and os.path.exists(partial) else 0
+
+            headers = {}
+
+            if have > 0:
+                headers["Range"] = "bytes=%d-" % have
+
+            try:
+                sent = time.time()
+                metrics["attempts"] += 1
+
+                try:
+                    my_r = self.get_download_session().get(
+                        link, stream = True, headers = headers,
+                        timeout = self.timeout)
+                finally:
+                    metrics["latency"] += time.time() - sent
+
+                metrics["status"] = my_r.status_code
+
+                try:
+                    if path is None:
+                        path = name_path(my_r.url)
+                        partial = path + ".part"
+
+                    if my_r.status_code == 416 and tries < 10:
+                        #the range starts past the end, which is only right
+                        #if we already have all of it ("bytes */<size>")
+                        size = my_r.headers.get("Content-Range",
+                                                "").split("/")[-1]
+
+                        if size.isdigit() and int(size) == have:
+                            break
+
+                        #the file's changed (or the part is junk): start over
+                        os.remove(partial)
+                        continue
+
+                    if my_r.status_code in [401, 403] and \
+                       resolve_link is not None and tries < 10:
+                        #the temporary link has probably expired
+                        link = resolve_link()
+                        continue
+
+                    if my_r.status_code >= 500 and tries < 10:
+                        if self.verbose:
+                            print "Download of %s failed (%d); retrying." % \
+                                (path, my_r.status_code)
+
+                        self.backoff(tries, None)
+                        continue
+
+                    my_r.raise_for_status()
+
+                    #a 200 (rather than a 206) means starting over
+                    mode = "ab" if my_r.status_code == 206 else "wb"
+
+                    with open(partial, mode) as f:
+                        for chunk in my_r.iter_content(
+                                self.download_buffer_size):
+                            f.write(chunk)
+                            metrics["bytes"] += len(chunk)
+
+                finally:
+                    my_r.close()
+
+                break
+
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as e:
+
+                if tries >= 10:
+                    self.record_request(metrics, type(e).__name__)
+                    raise
+
+                if self.verbose:
+                    print "Download of %s interrupted (%s); resuming." % \
+                        (path or link, e)
+
+                self.backoff(tries, None)
+
+            except requests.exceptions.RequestException as e:
+                #e.g. a 404, or a 403 with no way to get a new link
+                self.record_request(metrics, type(e).__name__)
+                raise
+
+        self.record_request(metrics)
+
+        os.rename(partial, path)
+
+        return os.path.getsize(path)
+
+    @staticmethod
+    def file_sha256(path, buffer_size = 1024 * 1024):
+
+        digest = hashlib.sha256()
+
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(buffer_size)
+
+                if not chunk:
+                    break
+
+                digest.update(chunk)
+
+        return digest.hexdigest()
+
+    def download_files(self, attachment_ids, destination_path = "",
+                       max_workers = 4):
+        """
+        Downloads many Attachables at once (as <Id>-<FileName>, so receipts
+        that share a name don't collide), resuming partial files and
+        skipping ones already downloaded: a file is skipped when its size
+        matches the Attachable's and its sha256 matches the one recorded in
+        the directory's .qbo_downloads.json manifest.
+
+        Returns a list of {"Id", "path", "status", "error"} dicts, status
+        being "downloaded", "skipped" or "failed".
+        """
+
+        manifest_path = os.path.join(destination_path or ".",
+                                     ".qbo_downloads.json")
+
+        manifest = {}
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+        manifest_lock = threading.Lock()
+
+        def download(attachment_id):
+
+            result = {"Id" : attachment_id, "path" : None, "status" : None,
+                      "error" : None}
+
+            try:
+                attachable = self.read_object("Attachable", attachment_id)
+
+                if "Id" not in attachable:
+                    raise Exception("No Attachable %s: %s" % \
+                                    (attachment_id, attachable))
+
+                path = os.path.join(destination_path or ".", "%s-%s" % \
+                                    (attachment_id, attachable["FileName"]))
+                result["path"] = path
+
+                known = manifest.get(str(attachment_id))
+
+                if known is not None and os.path.exists(path) and \
+                   os.path.getsize(path) == attachable.get("Size",
+                                                          known["size"]) and \
+                   self.file_sha256(path) == known["sha256"]:
+                    result["status"] = "skipped"
+                    return result
+
+                def resolve_link():
+                    return self.read_object("Attachable",
+                                            attachment_id)["TempDownloadUri"]
+
+                size = self.stream_to_file(attachable["TempDownloadUri"],
+                                           path, resolve_link)
+
+                with manifest_lock:
+                    manifest[str(attachment_id)] = {
+                        "file" : os.path.basename(path), "size" : size,
+                        "sha256" : self.file_sha256(path)}
+
+                result["status"] = "downloaded"
+
+            except Exception as e:
+                result["status"] = "failed"
+                result["error"] = e
+
+            return result
+
+        try:
+            results = run_in_pool(download,
+                                  [(Id,) for Id in attachment_ids],
+                                  max_workers)
+        finally:
+            with manifest_lock:
+                with open(manifest_path, "w") as f:
+                    json.dump(manifest, f, indent=1)
+
+        return results
+
+    def throttle(self):
+        """Waits for this realm's rate limiter to let a request through."""
+
+        rate_limiter_for(self.company_id,
+                         self.requests_per_minute / 60.0,
+                         self.request_burst).acquire()
+
+    def backoff(self, tries, response = None):
+        """
+        Sleeps before retry number `tries`: for as long as the server asked
+        (Retry-After) if it did, otherwise exponentially longer each time,
+        with full jitter so that concurrent callers don't retry in lockstep.
+        A 429 also holds back every other caller on this realm.
+        """
+
+        delay = None
+
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+
+            if retry_after is not None:
+                try:
+                    delay = float(retry_after)
+                except ValueError:
+                    delay = None
+
+        if delay is None:
+            delay = random.uniform(0, min(self.backoff_cap,
+                                          self.backoff_base * 2 ** (tries - 2)))
+
+        if response is not None and response.status_code == 429:
+            rate_limiter_for(self.company_id,
+                             self.requests_per_minute / 60.0,
+                             self.request_burst).hold(delay)
+
+        if self.verbose:
+            print "(backing off for %.2f seconds)" % delay
+
+        time.sleep(delay)
+
+    def hammer_it(self, request_type, url, request_body, content_type,
+                  accept = 'json', files=None, retry_timeouts = True,
+                  **req_kwargs):
+        """
+        A slim version of simonv3's excellent keep_trying method. Among other
+         trimmings, it assumes we can only use v3 of the
+         QBO API. It also allows for requests and responses
+         in xml OR json. (No xml parsing added yet but the way is paved...)
+        With retry_timeouts=False a timeout is raised straight away (for
+         callers that would rather ask for less than ask again).
+        Anything but a GET could already have been acted on when its
+         response is lost, so those are only re-sent after a failure to
+         connect, and carry a fixed requestid that QBO dedupes retries by.
+        """
+
+        trying       = True
+        print_error  = False
+
+        tries = 0
+        my_r = None
+
+        metrics = self.new_request_metrics(request_type, url, request_body,
+                                           params = req_kwargs.get("params"))
+
+        if not request_type == "GET":
+            req_kwargs["params"] = dict(req_kwargs.get("params") or {})
+            req_kwargs["params"].setdefault("requestid", uuid.uuid4().hex)
+
+        while trying:
+
+            tries += 1
+
+            if tries > 1:
+
+                #we don't want to get shut out...
+
+                self.backoff(tries, my_r)
+
+
+            if self.verbose and tries > 1:
+                print "(this is try#%d)" % tries
+
+            if accept == "filelink":
+                headers = {}
+            else:
+                headers = {
+                    'Accept': 'application/%s' % accept
+                    }
+
+            if not request_type == "GET" and files == None:
+
+                headers.update({
+
+                    'Content-Type': 'application/%s' % content_type
+
+                })
+
+            elif not files == None:
+
+                #files is a MultipartUpload, which knows its own boundary
+                headers.update({
+
+                    'Content-Type': files.content_type
+
+                })
+
+                request_body = files
+
+                #in case an earlier try got part of the way through it
+                files.seek(0)
+
+            try:
+
+                my_r = self.send_request(request_type, url, headers,
+                                         request_body, metrics = metrics,
+                                         **req_kwargs)
+
+            except requests.exceptions.RequestException as e:
+
+                #dropped connections and timeouts are worth another try,
+                #unless a write might have gone through (e.g. a ReadTimeout)
+                if tries >= 10 or (not retry_timeouts and \
+                   isinstance(e, requests.exceptions.Timeout)) or \
+                   (not request_type == "GET" and not isinstance(e,
+                       requests.exceptions.ConnectionError)):
+                    self.record_request(metrics, type(e).__name__)
+                    raise
+
+                if self.verbose or self.verbosity > 0:
+                    print "Request failed: %s" % e
+
+                my_r = None
+
+                continue
+
+            #import ipdb
+            #ipdb.set_trace()
+
+            if accept == "json":
+
+                decoding = time.time()
+
+                try:
+
+                    result = self.codec.decode(my_r.content)
+
+                except:
+
+                    if self.verbose or self.verbosity > 0:
+                        print my_r,
+
+                        if my_r.status_code in [503]:
+
+                            print " (Service Unavailable)"
+
+                        elif my_r.status_code in [401]:
+
+                            print " (Unauthorized -- a dubious response)"
+
+                        else:
+
+                            print " (json parse failed)"
+
+                    if self.verbosity > 8:
+
+                        print my_r.text
+
+                    result = {"Fault" : {"type":"(inconclusive)"}}
+
+                metrics["decode_time"] += time.time() - decoding
+
+                if "Fault" in result and \
+                   "type" in result["Fault"] and \
+                   result["Fault"]["type"] == "ValidationFault":
+
+                    if self.verbose or self.verbosity > 0:
+
+                        print "Fault alert!"
+
+                    trying = False
+                    print_error = True
+
+                elif tries >= 10:
+
+                    trying = False
+
+                    if "Fault" in result:
+                        print_error = True
+
+                elif "Fault" not in result:
+
+                    #sounds like a success
+                    trying = False
+
+                if (not trying and print_error) or \
+                   self.verbosity > 8:
+
+                    print json.dumps(result, indent=1)
+
+            elif accept== 'filelink':
+                self.record_request(metrics)
+                return my_r.text
+            else:
+                raise NotImplementedError("How do I parse a %s response?") \
+                    % accept
+
+        self.record_request(metrics, self.fault_type(result))
+
+        return result
+
+    @staticmethod
+    def fault_type(result):
+        """The type of the Fault in a decoded response, or None."""
+
+        try:
+            return result["Fault"].get("type", "(unknown)")
+        except (KeyError, TypeError, AttributeError):
+            return None
+
+    def keep_trying(self, r_type, url, header_auth, realm, payload=''):
+        """ Wrapper script around send_request() to continue trying at the QB
+        API until it returns something good, because the QB API is
+        inconsistent """
+
+        trying = True
+        tries = 0
+        r = None
+
+        metrics = self.new_request_metrics(r_type, url, payload, realm)
+
+        while trying:
+            tries += 1
+
+            if tries > 1:
+
+                self.backoff(tries, r)
+
+            if self.verbose and tries > 1:
+                print "(this is try#%d)" % tries
+
+
+            if "v2" in url:
+                try:
+                    r = self.send_request(r_type, url, data = payload,
+                                          realm = realm, stream = True,
+                                          metrics = metrics)
+
+                    #parse straight off the wire rather than via r.text
+                    r.raw.decode_content = True
+
+                    decoding = time.time()
+
+                    try:
+                        r_dict = xmltodict.parse(r.raw)
+                    finally:
+                        metrics["decode_time"] += time.time() - decoding
+                        r.close()
+
+                except (requests.exceptions.RequestException,
+                        ExpatError) as e:
+                    if tries > 10:
+                        self.record_request(metrics, type(e).__name__)
+                        raise
+                    r = None
+                    continue
+
+                if "FaultInfo" not in r_dict or tries > 10:
+                    trying = False
+            else:
+                headers = {
+                        'Content-Type': 'application/text',
+                        'Accept': 'application/json'
+                    }
+
+                #print r_type,url,header_auth,realm,headers,payload
+                #quit()
+                try:
+                    r = self.send_request(r_type, url, headers, payload,
+                                          realm = realm, metrics = metrics)
+                except requests.exceptions.RequestException as e:
+                    #dropped connections and timeouts are worth another try
+                    if tries > 10:
+                        self.record_request(metrics, type(e).__name__)
+                        raise
+                    r = None
+                    continue
+
+                decoding = time.time()
+
+                try:
+
+                    r_dict = self.codec.decode(r.content)
+
+                except:
+
+                    #I've seen, e.g. a ValueError ("No JSON object could be
+                    #decoded"), but there could be other errors here...
+
+                    if self.verbose:
+
+                        pass
+
+                        #print "failed to decode JSON object..."
+
+                        #import traceback
+                        #traceback.print_exc()
+
+                    r_dict = {"Fault":{"type":"(Inconclusive)"}}
+
+                metrics["decode_time"] += time.time() - decoding
+
+                if "Fault" not in r_dict or tries > 10:
+
+                    trying = False
+
+                elif "Fault" in r_dict and r_dict["Fault"]["type"]==\
+                     "AUTHENTICATION":
+
+                    #Initially I thought to quit here, but actually
+                    #it appears that there are 'false' authentication
+                    #errors all the time and you just have to keep trying...
+
+                    trying = True
+
+        if "FaultInfo" in r_dict:
+            self.record_request(metrics, "FaultInfo")
+        else:
+            self.record_request(metrics, self.fault_type(r_dict))
+
+        if "Fault" in r_dict:
+            print r_dict
+
+        return r_dict
+
+    def fetch_customer(self, pk):
+        if pk:
+            url = self.base_url_v3 + "/company/%s/customer/%s" % \
+                  (self.company_id, pk)
+
+            # url = self.base_url_v2 + "/resource/customer/v2/%s/%s" % \
+            #    ( self.company_id, pk)
+
+            r_dict = self.keep_trying("GET", url, True, self.company_id)
+            return r_dict['Customer']
+
+
+    def fetch_customers(self, all=False, page_num=0, limit=10):
+        # Sometimes we use v2 of the API
+        if all:
+            return list(self.iter_customers(True, 1, 30))
+
+        return list(self.iter_customers(False, page_num, limit))
+
+    def iter_customers(self, all = True, page_num = 1, limit = 30):
+        """
+        Yields the v2 customers one at a time, each as the dict xmltodict
+        made of it ({"ns0:Customer": {...}}, see element_to_dict).
+        Each page is iterparsed straight off the response stream, so only
+        the customer being converted is ever held as XML. With all=True it
+        pages through every customer, limit at a time; otherwise it's just
+        page page_num.
+        """
+
+        url = self.base_url_v2
+        url += "/resource/customers/v2/%s" % (self.company_id)
+
+        while True:
+            payload = {
+                "ResultsPerPage":str(limit),
+                "PageNum":str(page_num),
+                }
+
+            count = None
+            yielded = 0
+
+            trying = True
+            tries = 0
+            r = None
+
+            metrics = self.new_request_metrics("POST", url)
+
+            # Because the QB API is so iffy, let's try until we get an
+            # non-error
+            while trying:
+                tries += 1
+
+                if tries > 1:
+                    self.backoff(tries, r)
+
+                failed = False
+                seen = 0
+
+                try:
+                    r = self.send_request("POST", url, data = payload,
+                                          stream = True, metrics = metrics)
+                    r.raw.decode_content = True
+
+                    for tag, item in timed_iter(iterparse_items(r.raw,
+                            ["Customer", "Count", "ErrorCode"]), metrics):
+
+                        if tag == "ErrorCode":
+                            failed = True
+                            break
+
+                        elif tag == "Count":
+                            count = int(item.text)
+
+                        else:
+                            seen += 1
+
+                            #a retried page skips what we already yielded
+                            if seen > yielded:
+                                yielded += 1
+
+                                converting = time.time()
+                                customer = element_to_dict(item)
+                                metrics["decode_time"] += time.time() - \
+                                                          converting
+
+                                yield customer
+
+                except (requests.exceptions.RequestException,
+                        ET.ParseError) as e:
+                    if tries >= 10:
+                        self.record_request(metrics, type(e).__name__)
+                        raise
+
+                    failed = True
+
+                finally:
+                    if r is not None:
+                        r.close()
+
+                if not failed:
+                    trying = False
+
+                elif tries >= 10:
+                    self.record_request(metrics, "ErrorCode")
+                    raise Exception("Couldn't fetch page %s of customers" % \
+                                    page_num)
+
+                else:
+                    print "Failed"
+
+            self.record_request(metrics)
+
+            if count is None:
+                count = yielded
+
+            if not all or count < limit:
+                if all and self.verbose:
+                    print "Found all customers"
+                break
+
+            page_num += 1
+
+    def fetch_sales_term(self, pk):
+        if pk:
+            url = self.base_url_v2 + "/resource/sales-term/v2/%s/%s" % \
+                  ( self.company_id, pk)
+
+            r_dict = self.keep_trying("GET", url, True, self.company_id)
+            return r_dict
+
+    def fetch_invoices(self, **args):
+        qb_object = "Invoice"
+        payload = "SELECT * FROM %s" % (qb_object)
+        if "query" in args:
+            if "customer" in args['query']:
+                payload = ("SELECT * FROM %s WHERE "
+                    "CustomerRef = '%s'") % (
+                        qb_object, args['query']['customer']
+                        )
+
+        r_dict = self.query_fetch_more("POST", True,
+                self.company_id, qb_object, payload)
+
+        return r_dict
+
+
+    def fetch_purchases(self, **args):
+        # if "query" in args:
+            qb_object = "Purchase"
+
+            if self.ref_index is not None and \
+               "query" in args and "customer" in args['query']:
+
+                # the index already knows which purchases cite the customer
+                return [entry for q, entry, lines in \
+                        self.find_transactions("CustomerRef",
+                                               args['query']['customer'],
+                                               [qb_object])]
+
+            payload = ""
+            if "query" in args and "customer" in args['query']:
+
+                # if there is a customer, let's get the create date
+                # for that customer in QB, all relevant purchases will be
+                # after that date, this way we need less from QB
+
+                customer = self.fetch_customer(args['query']['customer'])
+
+                # payload = "SELECT * FROM %s" % (qb_object)
+                payload = "SELECT * FROM %s WHERE MetaData.CreateTime > '%s'" \
+                          % (qb_object, customer['MetaData']['CreateTime'])
+
+            else:
+
+                payload = "SELECT * FROM %s" % (qb_object)
+
+            unfiltered_purchases = self.query_fetch_more("POST", True,
+                self.company_id, qb_object, payload)
+
+            filtered_purchases = []
+
+            if "query" in args and "customer" in args['query']:
+                for entry in unfiltered_purchases:
+
+                    if (
+                        'Line' in entry
+                        ):
+                        for line in entry['Line']:
+                            if (
+                                'AccountBasedExpenseLineDetail' in line and \
+                                'CustomerRef' in \
+                                    line['AccountBasedExpenseLineDetail'] and \
+                                    line['AccountBasedExpenseLineDetail']\
+                                    ['CustomerRef']['value'] == \
+                                    args['query']['customer']
+                                ):
+
+                                filtered_purchases += [entry]
+
+                return filtered_purchases
+
+            else:
+
+                return unfiltered_purchases
+
+    def fetch_journal_entries(self, **args):
+        """ Because of the beautiful way that journal entries are organized
+        with QB, you're still going to have to filter these results for the
+        actual entity you're interested in.
+
+        :param query: a dictionary that includes 'customer',
+        and the QB id of the customer
+        """
+
+        if self.ref_index is not None and \
+           "query" in args and "class" in args['query']:
+
+            return self.find_transactions_for_class("JournalEntry",
+                                                    args['query']['class'])
+
+        if "query" in args and "project" in args['query']:
+            original_payload = "SELECT * FROM JournalEntry"
+
+        elif "query" in args and "raw" in args['query']:
+            original_payload = args['query']['raw']
+
+        else:
+            original_payload = "SELECT * FROM JournalEntry"
+
+        journal_entries = []
+
+        # pass keyset="Id" (or "MetaData.LastUpdatedTime") for keyset paging
+        for journal_entry_set in self.iter_query("JournalEntry",
+                                                 original_payload,
+                                                 pages = True,
+                                                 keyset = args.get("keyset")):
+
+            # This has to happen because the QBO API doesn't support
+            # filtering along customers apparently.
+            if "query" in args and "class" in args['query']:
+                for entry in journal_entry_set:
+                    for line in entry['Line']:
+                        if 'JournalEntryLineDetail' in line:
+                            if 'ClassRef' in line['JournalEntryLineDetail']:
+                                if args['query']['class'] in \
+                                   line['JournalEntryLineDetail']\
+                                   ['ClassRef']['name']:
+
+                                    journal_entries += [entry]
+
+                                    break
+
+            else:
+
+                journal_entries += journal_entry_set
+
+        return journal_entries
+
+    def fetch_bills(self, **args):
+        """Fetch the bills relevant to this project."""
+
+        if self.ref_index is not None and \
+           "query" in args and "class" in args['query']:
+
+            return self.find_transactions_for_class("Bill",
+                                                    args['query']['class'])
+        # if "query" in args:
+        if "query" in args and "customer" in args['query']:
+            original_payload = "SELECT * FROM Bill"
         elif "query" in args and "raw" in args['query']:
             original_payload = args['query']['raw']
         else:
-            original_payload = "SELECT * FROM Bill"
+            original_payload = "SELECT * FROM Bill"
+
+        bills = []
+
+        # pass keyset="Id" (or "MetaData.LastUpdatedTime") for keyset paging
+        for bill in self.iter_query("Bill", original_payload, pages = True,
+                                    keyset = args.get("keyset")):
+
+            # This has to happen because the QBO API doesn't support
+            # filtering along customers apparently.
+            if "query" in args and "class" in args['query']:
+
+                for entry in bill:
+
+                    for line in entry['Line']:
+
+                        if 'AccountBasedExpenseLineDetail' in line:
+                            line_detail = line['AccountBasedExpenseLineDetail']
+
+                            if 'ClassRef' in line_detail:
+                                name = line_detail['ClassRef']['name']
+
+                                if args['query']['class'] in name:
+                                    bills += [entry]
+                                    break
+            else:
+                bills += bill
+
+        return bills
+
+    def get_report(self, report_name, params = {}):
+        """
+        Tries to use the QBO reporting API:
+        https://developer.intuit.com/docs/0025_quickbooksapi/
+         0050_data_services/reports
+        """
+
+        url = self.base_url_v3 + "/company/%s/" % \
+              self.company_id + "reports/%s" % report_name
+
+        added_params_count = 0
+
+        return self.hammer_it("GET", url, None, "json",
+                              **{"params" : params})
+
+    def build_query_string(self, business_object, params={},
+                           query_tail = "", fields = None):
+        """
+        Builds the SELECT statement used by query_objects (and the iter_*
+        generators) from either a params dict or a whole query tail
+        fields, if given, is a list of properties to select instead of *
+        (Id is always included)
+        """
+
+        if business_object not in self._BUSINESS_OBJECTS:
+            raise Exception("%s not in list of QBO Business Objects." %  \
+                            business_object + " Please use one of the " + \
+                            "following: %s" % self._BUSINESS_OBJECTS)
+
+        #selecting only the fields you need makes for much smaller responses
+
+        if fields:
+            fields = ["Id"] + [f for f in fields if f != "Id"]
+            query_string="SELECT %s FROM %s" % (", ".join(fields),
+                                                business_object)
+        else:
+            query_string="SELECT * FROM %s" % business_object
+
+        if query_tail == "" and not params == {}:
+
+            #It's not entirely obvious what are valid properties for
+            #filtering, so we'll collect the working ones here and
+            #validate the properties before sending it
+            #datatypes are defined here:
+            #https://developer.intuit.com/docs/0025_quickbooksapi/
+            #    0050_data_services/020_key_concepts/0700_other_topics
+
+            props = {
+                "TxnDate":"Date",
+                "MetaData.CreateTime":"DateTime",      #takes a Date though
+                "MetaData.LastUpdatedTime":"DateTime"  #ditto
+            }
+
+            p = params.keys()
+
+            #only validating the property name for now, not the DataType
+            if p[0] not in props:
+                raise Exception("Unfamiliar property: %s" % p[0])
+
+            query_string+=" WHERE %s %s %s" % (p[0],
+                                               params[p[0]][0],
+                                               params[p[0]][1])
+
+            if len(p)>1:
+                for i in range(1,len(p)+1):
+                    if p[i] not in props:
+                        raise Exception("Unfamiliar property: %s" % p[i])
+
+                    query_string+=" AND %s %s %s" % (p[i],
+                                                     params[p[i]][0],
+                                                     params[p[i]][1])
+
+        elif not query_tail == "":
+            if not query_tail[0]==" ":
+                query_tail = " "+query_tail
+            query_string+=query_tail
+
+        return query_string
+
+    def report(self, report_name, params = {}, refresh = False):
+        """
+        get_report, flattened into a table (see flatten_report) and cached
+        for report_cache_ttl seconds, so dashboards asking for the same
+        report over and over are served locally. refresh=True skips the
+        cache.
+        """
+
+        if not refresh:
+            table = self.report_cache.get(report_name, params)
+
+            if table is not None:
+                return table
+
+        report = self.get_report(report_name, params)
+
+        if "Fault" in report:
+            raise Exception("Couldn't get the %s report: %s" % \
+                            (report_name, report))
+
+        table = flatten_report(report)
+
+        self.report_cache.put(report_name, params, table)
+
+        return table
+
+    def get_report_sharded(self, report_name, params, shard_days = 90,
+                           max_workers = 4, min_shard_days = 7):
+        """
+        get_report for long date ranges (e.g. a multi-year GeneralLedger or
+        TransactionList): splits params' start_date..end_date into
+        shard_days-long ranges, fetches them concurrently, and merges them
+        back into one report (see merge_reports). A shard that times out is
+        split in half and tried again, down to min_shard_days.
+
+        Each shard would have its own period columns, so summarize_column_by
+        (other than the default Total) isn't supported here. Reports that
+        aren't ADDITIVE_REPORTS (balances as of a date) can't be added up
+        from shards, so they're fetched with a single get_report.
+        """
+
+        if report_name not in ADDITIVE_REPORTS:
+            if self.verbose:
+                print "%s can't be sharded; fetching it in one go." % \
+                    report_name
+
+            return self.get_report(report_name, params)
+
+        if params.get("summarize_column_by", "Total") != "Total":
+            raise Exception("get_report_sharded can't merge reports " + \
+                            "summarized by %s; use get_report." % \
+                            params["summarize_column_by"])
+
+        if shard_days < 1 or min_shard_days < 1:
+            raise Exception("shard_days and min_shard_days must be at " + \
+                            "least 1 (got %s and %s)." % \
+                            (shard_days, min_shard_days))
+
+        start = datetime.datetime.strptime(params["start_date"],
+                                           "%Y-%m-%d").date()
+        end = datetime.datetime.strptime(params["end_date"], "%Y-%m-%d").date()
+
+        shards = []
+
+        while start <= end:
+            shard_end = min(end, start + datetime.timedelta(shard_days - 1))
+            shards.append((report_name, params, start, shard_end,
+                           min_shard_days))
+            start = shard_end + datetime.timedelta(1)
+
+        if self.verbose:
+            print "Fetching %s in %d shards." % (report_name, len(shards))
+
+        reports = []
+
+        for shard_reports in run_in_pool(self.get_report_shard, shards,
+                                         max_workers):
+            reports += shard_reports
+
+        return merge_reports(reports, params["start_date"],
+                             params["end_date"])
+
+    def get_report_shard(self, report_name, params, start, end,
+                         min_shard_days = 7):
+        """
+        Fetches the report for start..end, splitting the range in half
+        (recursively) if it times out. Returns the list of reports fetched,
+        in date order.
+        """
+
+        shard_params = dict(params)
+        shard_params["start_date"] = start.strftime("%Y-%m-%d")
+        shard_params["end_date"] = end.strftime("%Y-%m-%d")
+
+        url = self.base_url_v3 + "/company/%s/" % \
+              self.company_id + "reports/%s" % report_name
+
+        days = (end - start).days + 1
+
+        try:
+            report = self.hammer_it("GET", url, None, "json",
+                                    retry_timeouts = days <= min_shard_days,
+                                    **{"params" : shard_params})
+
+        except requests.exceptions.Timeout:
+
+            #a single day can't be split any further
+            if days < 2:
+                raise
+
+            if self.verbose:
+                print "%s to %s timed out; splitting it." % \
+                    (shard_params["start_date"], shard_params["end_date"])
+
+            middle = start + datetime.timedelta(days // 2 - 1)
+
+            return self.get_report_shard(report_name, params, start, middle,
+                                         min_shard_days) + \
+                   self.get_report_shard(report_name, params,
+                                         middle + datetime.timedelta(1), end,
+                                         min_shard_days)
+
+        if "Fault" in report:
+            raise Exception("Couldn't get the %s report for %s to %s: %s" % \
+                            (report_name, shard_params["start_date"],
+                             shard_params["end_date"], report))
+
+        return [report]
+
+    def query_objects(self, business_object, params={}, query_tail = "",
+                      concurrent = False, max_workers = 4, fields = None,
+                      keyset = None):
+        """
+        Runs a query-type request against the QBOv3 API
+        Gives you the option to create an AND-joined query by parameter
+            or just pass in a whole query tail
+        The parameter dicts should be keyed by parameter name and
+            have twp-item tuples for values, which are operator and criterion
+        Pass concurrent=True to fetch the result pages in parallel
+        Pass a list of fields to only select those properties
+        Pass keyset="Id" (or "MetaData.LastUpdatedTime") for keyset paging
+        """
+
+        query_string = self.build_query_string(business_object, params,
+                                               query_tail, fields)
+
+        #CAN ONE SESSION USE MULTIPLE COMPANIES?
+        #IF NOT, REMOVE THE COMPANY OPTIONALITY
+        url = self.base_url_v3 + "/company/%s/query" % self.company_id
+
+        #print query_string
+
+        results = self.query_fetch_more(r_type="POST",
+                                        header_auth=True,
+                                        realm=self.company_id,
+                                        qb_object=business_object,
+                                        original_payload=query_string,
+                                        concurrent=concurrent,
+                                        max_workers=max_workers,
+                                        keyset=keyset)
+
+        return results
+
+    def iter_query(self, qb_object, original_payload, pages = False,
+                   max_results = 500, keyset = None, stream = None):
+        """
+        Generator version of query_fetch_more: yields each record (or, with
+        pages=True, each list of up to max_results records) as soon as its
+        page arrives, so only one page is ever held in memory.
+
+        Just stop iterating (break, or close() the generator) to terminate
+        early; no further pages are requested.
+
+        Pass keyset="Id" or keyset="MetaData.LastUpdatedTime" to page by
+        key instead of by STARTPOSITION (see iter_query_keyset).
+
+        With stream=True (default: stream_json) each page is decoded as it
+        comes off the socket, so records come out before the page is done.
+        """
+
+        if keyset is not None:
+            for page in self.iter_query_keyset(qb_object, original_payload,
+                                               keyset, pages, max_results):
+                yield page
+            return
+
+        if stream is None:
+            stream = self.stream_json
+
+        start_position = 1
+
+        while stream and not pages:
+
+            if start_position <= 1:
+                payload = "%s MAXRESULTS %s" % (original_payload, max_results)
+            else:
+                payload = "%s STARTPOSITION %s MAXRESULTS %s" % \
+                    (original_payload, start_position, max_results)
+
+            count = 0
+
+            for record in self.query_stream(qb_object, payload):
+                count += 1
+                yield record
+
+            if count < max_results:
+                return
+
+            start_position += max_results
+
+        while True:
+
+            page = self.query_fetch_page("POST", qb_object, original_payload,
+                                         start_position, max_results)
+
+            if self.verbose:
+                print "(batch begins with record %d)" % start_position
+
+            if len(page) > 0:
+                if pages:
+                    yield page
+                else:
+                    for record in page:
+                        yield record
+
+            if len(page) < max_results:
+                break
+
+            start_position += max_results
+
+    def iter_query_keyset(self, qb_object, original_payload, keyset = "Id",
+                          pages = False, max_results = 500):
+        """
+        Pages through a query with WHERE <key> > <last key seen> ORDERBY
+        <key> instead of growing STARTPOSITION offsets, so every page costs
+        the server the same and rows changing mid-scan can't shift the pages
+        under us (no skipped or repeated records).
+
+        keyset is "Id" (the default) or "MetaData.LastUpdatedTime".
+        Timestamps aren't unique, so that one asks for >= and keeps the Ids
+        it's yielded to drop repeats. That also covers a record edited
+        during the scan, which comes round again with its new timestamp:
+        it's only yielded the first time (as it was then), so this isn't a
+        snapshot of any one moment. Id order has no such problem.
+
+        The query mustn't have its own ORDERBY.
+        """
+
+        if keyset not in ["Id", "MetaData.LastUpdatedTime"]:
+            raise Exception("Can't page by %s; use Id or " % keyset + \
+                            "MetaData.LastUpdatedTime.")
+
+        if re.search(r"(?i)\sORDER\s*BY\s", original_payload):
+            raise Exception("Keyset paging does its own ORDERBY: %s" % \
+                            original_payload)
+
+        if re.search(r"(?i)\sWHERE\s", original_payload):
+            joiner = " AND "
+        else:
+            joiner = " WHERE "
+
+        last = None
+        yielded = set()
+
+        while True:
+
+            if last is None:
+                payload = "%s ORDERBY %s" % (original_payload, keyset)
+            elif keyset == "Id":
+                payload = "%s%sId > '%s' ORDERBY Id" % (original_payload,
+                                                        joiner, last)
+            else:
+                payload = "%s%s%s >= '%s' ORDERBY %s" % (original_payload,
+                                                         joiner, keyset, last,
+                                                         keyset)
+
+            page = self.query_fetch_page("POST", qb_object, payload, 1,
+                                         max_results)
+
+            if self.verbose:
+                print "(batch begins after %s %s)" % (keyset, last)
+
+            full_page = len(page) == max_results
+
+            if keyset == "Id":
+                if len(page) > 0:
+                    last = page[-1]["Id"]
+            else:
+                if len(page) > 0:
+                    newest = page[-1]["MetaData"]["LastUpdatedTime"]
+
+                    if full_page and newest == last:
+                        #the whole page is at last, so we'd never get past it
+                        raise Exception("More than %d %ss share the " % \
+                                        (max_results, qb_object) + \
+                                        "LastUpdatedTime %s; page by Id." % \
+                                        last)
+
+                    last = newest
+
+                page = [o for o in page if o["Id"] not in yielded]
+
+                yielded.update(o["Id"] for o in page)
+
+            if len(page) > 0:
+                if pages:
+                    yield page
+                else:
+                    for record in page:
+                        yield record
+
+            if not full_page:
+                break
+
+    def iter_objects(self, business_object, params={}, query_tail = "",
+                     pages = False, fields = None, keyset = None,
+                     stream = None):
+        """
+        Same query as query_objects, but yields the results one at a time
+        (or a page at a time) instead of building the whole list first
+        """
+
+        query_string = self.build_query_string(business_object, params,
+                                               query_tail, fields)
+
+        return self.iter_query(business_object, query_string, pages,
+                               keyset = keyset, stream = stream)
+
+    def change_data_capture(self, qbbo_list, changed_since):
+        """
+        Asks the QBO cdc endpoint for everything of these types that changed
+        (including deletions) after changed_since (epoch seconds; QBO only
+        looks back 30 days).
+
+        Returns a dict of lists, keyed by qbbo. Deleted objects come back as
+        stubs with "status":"Deleted".
+        """
+
+        url = self.base_url_v3 + "/company/%s/cdc" % \
+              self.company_id
+
+        params = {
+            "entities" : ",".join(qbbo_list),
+            "changedSince" : time.strftime("%Y-%m-%dT%H:%M:%S-00:00",
+                                           time.gmtime(changed_since))
+        }
+
+        response = self.hammer_it("GET", url, None, "json",
+                                  **{"params" : params})
+
+        if "CDCResponse" not in response:
+            raise Exception("Change data capture failed: %s" % response)
+
+        changes = {}
+
+        for qbbo in qbbo_list:
+            changes[qbbo] = []
+
+        for cdc_response in response["CDCResponse"]:
+            for query_response in cdc_response.get("QueryResponse", []):
+                for qbbo in qbbo_list:
+                    changes[qbbo] += query_response.get(qbbo, [])
+
+        return changes
+
+    def refresh_objects(self, qbbo_list):
+        """
+        Brings the <qbbo>s dicts up to date in place. Types that have a
+        recent enough watermark are refreshed with a single change data
+        capture request; the rest fall back to a full requery.
+        """
+
+        now = time.time()
+
+        incremental = [qbbo for qbbo in qbbo_list
+                       if hasattr(self, qbbo+"s") and \
+                          qbbo in self.cdc_watermarks and \
+                          now - self.cdc_watermarks[qbbo] < self.cdc_window]
+
+        full = [qbbo for qbbo in qbbo_list if qbbo not in incremental]
+
+        if len(incremental) > 0:
+
+            changed_since = min([self.cdc_watermarks[qbbo]
+                                 for qbbo in incremental])
+
+            #a little slack for the clock difference between us and Intuit
+            changes = self.change_data_capture(incremental,
+                                               changed_since - 60)
+
+            for qbbo in incremental:
+
+                if len(changes[qbbo]) >= self.cdc_max_results:
+                    #we can't tell what got cut off, so just start over
+                    full.append(qbbo)
+                    continue
+
+                object_dict = getattr(self, qbbo+"s")
+
+                changed = []
+                deleted = []
+
+                for o in changes[qbbo]:
+                    if o.get("status") == "Deleted":
+                        object_dict.pop(o["Id"], None)
+                        deleted.append(o["Id"])
+                    else:
+                        object_dict[o["Id"]] = self.prepare_object(qbbo, o)
+                        changed.append(o)
+
+                self.cdc_watermarks[qbbo] = now
+
+                self.objects_changed(qbbo, changed, deleted, synced_at = now)
+
+                if self.verbose:
+                    print "Merged %d changed %ss." % (len(changes[qbbo]), qbbo)
+
+        for qbbo in full:
+            self.get_objects(qbbo, requery=True)
+
+        return self.object_dicts(qbbo_list)
+
+    def warm_start(self, qbbo):
+        """
+        Loads the <qbbo>s dict from the EntityStore, then fetches only what
+        changed since it was saved: through change data capture if the
+        store is recent enough, otherwise by querying for anything with a
+        newer MetaData.LastUpdatedTime. That query can't see deletions, so
+        it's followed by an Id-only query of everything there is, and
+        whatever's no longer there is dropped.
+
+        Returns False if there was nothing stored for this type.
+        """
+
+        object_dict = self.store.load(self.company_id, qbbo)
+
+        if self.compact_entities:
+            for Id, o in object_dict.items():
+                object_dict[Id] = self.prepare_object(qbbo, o)
+
+        if len(object_dict) == 0:
+            return False
+
+        if self.verbose:
+            print "Loaded %d %ss from the store." % (len(object_dict), qbbo)
+
+        setattr(self, qbbo+"s", object_dict)
+
+        if self.ref_index is not None and qbbo in self._TRANSACTION_OBJECTS:
+            self.ref_index.update(qbbo, object_dict.values(), replace = True)
+
+        synced_at = self.store.synced_at(self.company_id, qbbo)
+
+        last_updated = self.store.last_updated(self.company_id, qbbo)
+
+        if (synced_at is not None and \
+            time.time() - synced_at < self.cdc_window) or \
+           last_updated is None:
+
+            #refresh_objects falls back to a full requery if it has to
+            if synced_at is not None:
+                self.cdc_watermarks[qbbo] = synced_at
+
+            self.refresh_objects([qbbo])
+
+            return True
+
+        started = time.time()
+
+        query_tail = "WHERE MetaData.LastUpdatedTime > '%s'" % last_updated
+
+        if qbbo in self._NAME_LIST_OBJECTS:
+            query_tail = "WHERE Active IN (true,false) AND " + query_tail[6:]
+
+        changed = []
+
+        for o in self.iter_objects(qbbo, query_tail = query_tail):
+            object_dict[o["Id"]] = self.prepare_object(qbbo, o)
+            changed.append(o)
+
+        #cdc can't look back this far, so find deletions by their absence
+        if qbbo in self._NAME_LIST_OBJECTS:
+            query_tail = "WHERE Active IN (true,false)"
+        else:
+            query_tail = ""
+
+        existing = set(o["Id"] for o in self.iter_objects(
+            qbbo, query_tail = query_tail, fields = ["Id"]))
+
+        deleted = [Id for Id in object_dict if Id not in existing]
+
+        for Id in deleted:
+            del object_dict[Id]
+
+        if self.verbose:
+            print "Fetched %d changed and dropped %d deleted %ss." % \
+                (len(changed), len(deleted), qbbo)
+
+        self.cdc_watermarks[qbbo] = started
+
+        self.objects_changed(qbbo, changed, deleted, synced_at = started)
+
+        return True
+
+    def get_objects(self,
+                    qbbo,
+                    requery=False,
+                    params = {},
+                    query_tail = "",
+                    incremental = False,
+                    fields = None):
+        """
+        Rather than have to look up the account that's associate with an
+        invoice item, for example, which requires another query, it might
+        be easier to just have a local dict for reference.
+
+        The same is true with linked transactions, so transactions can
+        also be cloned with this method
+
+        With requery and incremental both True, an unfiltered dict is
+        brought up to date through change data capture (see refresh_objects)
+        instead of being downloaded all over again.
+
+        If the session has a store, an uncached unfiltered dict is loaded
+        from disk first and only the newer objects are fetched.
+
+        With fields, the (partial) objects are returned in a new dict and
+        never cached, so they can't stand in for the full ones later.
+        """
+
+        #we'll call the attributes by the Business Object's name + 's',
+        #case-sensitive to what Intuit's documentation uses
+
+        if qbbo not in self._BUSINESS_OBJECTS:
+
+            raise Exception("%s is not a valid QBO Business Object." % qbbo)
+
+        elif qbbo in self._NAME_LIST_OBJECTS and query_tail == "":
+
+            #to avoid confusion from 'deleted' accounts later...
+            query_tail = "WHERE Active IN (true,false)"
+
+        attr_name = qbbo+"s"
+
+        if fields:
+            object_dict = {}
+
+            for o in self.iter_objects(qbbo, params, query_tail,
+                                       fields = fields):
+                object_dict[o["Id"]] = o
+
+            return object_dict
+
+        #only an unfiltered dict can be kept current through cdc
+        unfiltered = params == {} and \
+                     query_tail in ["", "WHERE Active IN (true,false)"]
+
+        if requery and incremental and unfiltered and \
+           hasattr(self, attr_name):
+
+            self.refresh_objects([qbbo])
+
+            return getattr(self, attr_name)
+
+        if not hasattr(self, attr_name) and not requery and unfiltered and \
+           self.store is not None and self.warm_start(qbbo):
+
+            return getattr(self, attr_name)
+
+        #if we've already populated this list, only redo if told to
+        #because, say, we've created another Account or Item or something
+        #during the session
+
+        if not hasattr(self,attr_name) or requery:
+
+            if self.verbose:
+                print "Caching list of %ss." % qbbo
+
+            started = time.time()
+
+            #let's dictionarize it (keyed by Id), though, for easy lookup later
+            #(streaming it in, so we never hold the list AND the dict)
+
+            object_dict = {}
+
+            for o in self.iter_objects(qbbo, params, query_tail):
+                Id = o["Id"]
+
+                object_dict[Id] = self.prepare_object(qbbo, o)
+
+            setattr(self, attr_name, object_dict)
+
+            if unfiltered:
+                self.cdc_watermarks[qbbo] = started
+
+                self.objects_changed(qbbo, object_dict.values(),
+                                     replace = True, synced_at = started)
+            else:
+                self.cdc_watermarks.pop(qbbo, None)
+
+                if self.ref_index is not None and \
+                   qbbo in self._TRANSACTION_OBJECTS:
+                    self.ref_index.update(qbbo, object_dict.values(),
+                                          replace = True)
+
+        return getattr(self,attr_name)
+
+    def object_dicts(self,
+                     qbbo_list = [],
+                     requery=False,
+                     params={},
+                     query_tail="",
+                     incremental=False):
+        """
+        returns a dict of dicts of ALL the Business Objects of
+        each of these types (filtering with params and query_tail)
+
+        with requery and incremental, the cached dicts are refreshed with
+        one change data capture request rather than full downloads
+        """
+
+        if requery and incremental and params == {} and \
+           query_tail in ["", "WHERE Active IN (true,false)"]:
+
+            return self.refresh_objects(qbbo_list)
+
+        object_dicts = {}       #{qbbo:[object_list]}
+
+        for qbbo in qbbo_list:
+
+            if qbbo == "TimeActivity":
+                #for whatever reason, this failed with some basic criteria, so
+                query_tail = ""
+            elif qbbo in self._NAME_LIST_OBJECTS and query_tail == "":
+                #just something to avoid confusion from 'deleted' accounts later
+                query_tail = "WHERE Active IN (true,false)"
+
+            object_dicts[qbbo] = self.get_objects(qbbo,
+                                                  requery,
+                                                  params,
+                                                  query_tail)
+
+        return object_dicts
+
+    def names(self,
+              requery=False,
+              params = {},
+              query_tail = "WHERE Active IN (true,false)",
+              incremental = False):
+        """
+        get a dict of every Name List Business Object (of every type)
+
+        results are subject to the filter if applicable
+        (pass incremental=True with requery to only fetch what changed)
+
+        returned dict has two dimensions:
+        name = names[qbbo][Id]
+        """
+
+        return self.object_dicts(self._NAME_LIST_OBJECTS, requery,
+                                 params, query_tail, incremental)
+
+    def transactions(self,
+                     requery=False,
+                     params = {},
+                     query_tail = "",
+                     incremental = False):
+        """
+        get a dict of every Transaction Business Object (of every type)
+
+        results are subject to the filter if applicable
+        (pass incremental=True with requery to only fetch what changed)
+
+        returned dict has two dimensions:
+        transaction = transactions[qbbo][Id]
+        """
+
+        return self.object_dicts(self._TRANSACTION_OBJECTS, requery,
+                                        params, query_tail, incremental)
+
+    def ledger(self, requery = False, incremental = False):
+        """
+        Builds a LedgerEngine (general ledger lines as NumPy arrays) from
+        every cached transaction type, fetching whatever isn't cached yet.
+        """
+
+        engine = LedgerEngine(items = self.get_objects("Item"),
+                              account_names = self.get_objects("Account"))
+
+        for qbbo, transactions in self.transactions(
+                requery, incremental = incremental).items():
+            engine.add_transactions(qbbo, transactions.itervalues())
+
+        return engine
+
+class AsyncQuickBooks():
+    """
+    A non-blocking front for QuickBooks: the same calls, but each one is
+    queued on a WorkerPool and returns a Future straight away, so many
+    requests (across realms too, if clients share a pool) can be in flight
+    at once without managing threads yourself.
+
+    Takes the same arguments as QuickBooks, plus an optional shared `pool`
+    (or `max_workers` for a pool of its own). The blocking client is still
+    there as .client.
+    """
+
+    def __init__(self, pool = None, max_workers = 8, **args):
+
+        self.client = QuickBooks(**args)
+
+        if pool is None:
+            pool = WorkerPool(max_workers)
+
+        self.pool = pool
+
+        #enough pooled connections for every worker
+        self.client.pool_size = max(self.client.pool_size, pool.max_workers)
+
+    def submit(self, method_name, *args, **kwargs):
+        """Runs any QuickBooks method on the pool and returns its Future."""
+
+        return self.pool.submit(getattr(self.client, method_name),
+                                *args, **kwargs)
+
+    def query_objects(self, business_object, params={}, query_tail = "",
+                      fields = None):
+        return self.submit("query_objects", business_object, params,
+                           query_tail, fields = fields)
+
+    def get_objects(self, qbbo, requery=False, params = {}, query_tail = "",
+                    incremental = False, fields = None):
+        return self.submit("get_objects", qbbo, requery, params, query_tail,
+                           incremental, fields)
+
+    def read_object(self, qbbo, object_id, content_type = "json"):
+        return self.submit("read_object", qbbo, object_id, content_type)
+
+    def create_object(self, qbbo, request_body, content_type = "json"):
+        return self.submit("create_object", qbbo, request_body, content_type)
+
+    def get_report(self, report_name, params = {}):
+        return self.submit("get_report", report_name, params)
+
+    def download_file(self, attachment_id, destination_path=""):
+        return self.submit("download_file", attachment_id, destination_path)
+
+class MultiRealmSync():
+    """
+    Runs names() / transactions() / report pulls for many companies at once.
+
+    realms is a list of QuickBooks argument dicts (company_id plus whatever
+    creds differ per realm); anything passed as shared_args applies to all
+    of them. Every client shares one connection pool, each realm has at most
+    realm_concurrency jobs in flight (on top of its rate limiter), and no
+    more than max_workers jobs run altogether. A realm's next job is only
+    handed to the pool once one of its running jobs finishes, so workers
+    never sit waiting on a busy realm while other realms have work.
+
+    progress, if given, is called as progress(realm, job, error, done, total)
+    after every job; error is None if the job worked.
+    """
+
+    def __init__(self, realms, max_workers = 16, realm_concurrency = 4,
+                 progress = None, **shared_args):
+
+        self.pool = WorkerPool(max_workers)
+        self.progress = progress
+        self.realm_concurrency = realm_concurrency
+        self.lock = threading.Lock()
+        self.finished = threading.Condition(self.lock)
+
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=4,
+                                                     pool_maxsize=max_workers)
+
+        self.clients = {}
+
+        #{realm: jobs not yet handed to the pool}, {realm: jobs in the pool}
+        self.pending = {}
+        self.in_flight = {}
+
+        for realm_args in realms:
+
+            args = dict(shared_args)
+            args.update(realm_args)
+            args["adapter"] = self.adapter
+
+            client = QuickBooks(**args)
+
+            realm = str(client.company_id)
+
+            self.clients[realm] = client
+            self.pending[realm] = collections.deque()
+            self.in_flight[realm] = 0
+
+    def dispatch(self, realm, results, futures):
+        """Hands realm's pending jobs to the pool while it has free slots."""
+
+        with self.lock:
+            ready = []
+
+            while self.pending[realm] and \
+                  self.in_flight[realm] < self.realm_concurrency:
+                ready.append(self.pending[realm].popleft())
+                self.in_flight[realm] += 1
+
+        for job, func, args in ready:
+            future = self.pool.submit(self.run_job, realm, job, func, args,
+                                      results, futures)
+
+            with self.lock:
+                futures.append(future)
+
+    def run_job(self, realm, job, func, args, results, futures):
+
+        try:
+            value = func(*args)
+            error = None
+        except Exception as e:
+            value = None
+            error = e
+
+        with self.lock:
+            section, key = job
+
+            if error is None:
+                results[realm][section][key] = value
+            else:
+                results[realm]["errors"]["%s %s" % job] = error
+
+            results[realm]["done"] += 1
+            self.in_flight[realm] -= 1
+
+            done = results[realm]["done"]
+            total = results[realm]["total"]
+
+        #this realm has a free slot now
+        self.dispatch(realm, results, futures)
+
+        with self.lock:
+            self.finished.notify_all()
+
+        if self.progress is not None:
+            self.progress(realm, "%s %s" % job, error, done, total)
+
+    def run(self, names = True, transactions = True, reports = [],
+            requery = False, incremental = False):
+        """
+        Syncs every realm and returns a dict keyed by realm of
+            {"names": {qbbo: {Id: object}},
+             "transactions": {qbbo: {Id: object}},
+             "reports": {report_name: report},
+             "errors": {"<section> <name>": exception},
+             "done": jobs finished, "total": jobs planned}
+
+        reports is a list of (report_name, params) tuples. Each business
+        object type and report is its own job, so one failure doesn't take
+        the rest of that realm's sync down with it.
+        """
+
+        results = {}
+        futures = []
+
+        for realm, client in self.clients.items():
+
+            jobs = []
+
+            if names:
+                for qbbo in client._NAME_LIST_OBJECTS:
+                    jobs.append((("names", qbbo), client.get_objects,
+                                 (qbbo, requery, {}, "", incremental)))
+
+            if transactions:
+                for qbbo in client._TRANSACTION_OBJECTS:
+                    jobs.append((("transactions", qbbo), client.get_objects,
+                                 (qbbo, requery, {}, "", incremental)))
+
+            for report_name, params in reports:
+                jobs.append((("reports", report_name), client.get_report,
+                             (report_name, params)))
+
+            results[realm] = {"names" : {}, "transactions" : {},
+                              "reports" : {}, "errors" : {},
+                              "done" : 0, "total" : len(jobs)}
+
+            self.pending[realm].extend(jobs)
+
+        #one slot per realm at a time, so the first jobs alternate realms
+        for slot in range(self.realm_concurrency):
+            for realm in self.clients:
+                with self.lock:
+                    if not self.pending[realm] or \
+                       self.in_flight[realm] > slot:
+                        continue
+
+                    job = self.pending[realm].popleft()
+                    self.in_flight[realm] += 1
+
+                future = self.pool.submit(self.run_job, realm, job[0],
+                                          job[1], job[2], results, futures)
+
+                with self.lock:
+                    futures.append(future)
+
+        with self.lock:
+            while any(result["done"] < result["total"]
+                      for result in results.values()):
+                self.finished.wait()
+
+            futures = list(futures)
+
+        #re-raises anything progress() raised
+        wait_all(futures)
+
+        return results
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+class ColumnarExporter():
+    """
+    Flattens business objects into typed columnar tables: one header-level
+    table per type (nested refs etc. become dotted columns such as
+    CustomerRef.value), plus a line-level table for types with Lines (keyed
+    by TxnId and LineIndex). Records are streamed from the query paginator
+    a page at a time and turned straight into Arrow record batches, so
+    nothing is held in the get_objects dicts along the way.
+
+    A table's schema grows as it goes: a column that first shows up on a
+    later page gets a typed column of its own, and one that's all null at
+    first (a sparse field like DueDate) takes its type from the first page
+    with a value in it. Columns of mixed types (say strings and numbers)
+    are kept as strings, with non-strings json-encoded. Only values that
+    don't fit a column's established type go, as json, in _extra.
+
+    Needs pyarrow.
+    """
+
+    def __init__(self, client, page_size = 500):
+
+        if pyarrow is None:
+            raise Exception("ColumnarExporter needs pyarrow installed.")
+
+        self.client = client
+        self.page_size = page_size
+
+    def flatten(self, value, prefix, row):
+        """Flattens nested dicts into dotted keys; lists become json."""
+
+        for k, v in value.items():
+            name = prefix + k
 
-        payload = original_payload + " MAXRESULTS " + str(max_results)
+            if isinstance(v, dict):
+                self.flatten(v, name + ".", row)
+            elif isinstance(v, list):
+                row[name] = default_codec.encode(v)
+            else:
+                row[name] = v
 
-        while more:
+        return row
 
-            url = self.base_url_v3 + "/company/%s/query" % (self.company_id)
+    def rows(self, o):
+        """Returns (header row, [line rows]) for one object."""
 
-            r_dict = self.keep_trying("POST", url, True,
-                                      self.company_id, payload)
-            counter = counter + 1
-            if int(r_dict['QueryResponse']['maxResults']) < max_results:
-                more = False
+        if isinstance(o, CompactEntity):
+            o = o.to_dict()
 
-            #take into account the initial start position
-            if start_position == 0:
-                start_position = 1
-            start_position = start_position + max_results
+        header = {}
+        lines = []
 
-            # set new payload
-            payload = "%s STARTPOSITION %s MAXRESULTS %s" % (
-                original_payload,
-                start_position,
-                max_results)
-            bill = r_dict['QueryResponse']['Bill']
+        for k, v in o.items():
+            if k != "Line":
+                self.flatten({k : v}, "", header)
 
-            # This has to happen because the QBO API doesn't support
-            # filtering along customers apparently.
-            if "query" in args and "class" in args['query']:
+        for position, line in enumerate(o.get("Line", [])):
+            row = {"TxnId" : o["Id"], "LineIndex" : position}
+            lines.append(self.flatten(line, "", row))
 
-                for entry in bill:
+        return header, lines
 
-                    for line in entry['Line']:
+    # the only genuinely integer columns; other numbers (amounts, balances,
+    # quantities) come back as 10 or 10.5 alike, so they're all floats
+    INTEGER_COLUMNS = ["LineIndex", "LineNum"]
 
-                        if 'AccountBasedExpenseLineDetail' in line:
-                            line_detail = line['AccountBasedExpenseLineDetail']
+    def typed(self, name, values):
+        """Dates become dates, and numbers floats (see INTEGER_COLUMNS)."""
 
-                            if 'ClassRef' in line_detail:
-                                name = line_detail['ClassRef']['name']
+        if name.endswith("Date"):
+            try:
+                return [datetime.datetime.strptime(v, "%Y-%m-%d").date()
+                        if v is not None else None for v in values]
+            except (TypeError, ValueError):
+                return values
 
-                                if args['query']['class'] in name:
-                                    bills += [entry]
-                                    break
-            else:
-                bills += bill
+        if name not in self.INTEGER_COLUMNS:
+            return [float(v) if isinstance(v, (int, long)) and \
+                    not isinstance(v, bool) else v for v in values]
 
-        return bills
+        return values
 
-    def get_report(self, report_name, params = {}):
+    @staticmethod
+    def to_array(values, column_type = None):
         """
-        Tries to use the QBO reporting API:
-        https://developer.intuit.com/docs/0025_quickbooksapi/
-         0050_data_services/reports
+        pyarrow.array(values), typed as column_type if given, or inferred.
+        If the values are of mixed types (and a string column would do) it
+        falls back to strings, json-encoding whatever isn't one.
         """
 
-        url = "https://quickbooks.api.intuit.com/v3/company/%s/" % \
-              self.company_id + "reports/%s" % report_name
+        try:
+            return pyarrow.array(values, type = column_type)
 
-        added_params_count = 0
+        except (pyarrow.ArrowException, TypeError, ValueError):
+            if column_type is not None and \
+               not column_type.equals(pyarrow.string()):
+                raise
 
-        return self.hammer_it("GET", url, None, "json",
-                              **{"params" : params})
+            return pyarrow.array([value if value is None or
+                                  isinstance(value, basestring)
+                                  else default_codec.encode(value)
+                                  for value in values],
+                                 type = pyarrow.string())
 
-    def query_objects(self, business_object, params={}, query_tail = ""):
+    def record_batch(self, rows, schema = None):
         """
-        Runs a query-type request against the QBOv3 API
-        Gives you the option to create an AND-joined query by parameter
-            or just pass in a whole query tail
-        The parameter dicts should be keyed by parameter name and
-            have twp-item tuples for values, which are operator and criterion
+        Turns rows into a record batch following schema (if it's given),
+        with new columns added (after schema's) and all-null ones typed as
+        their values dictate. Values that don't fit schema go in _extra.
         """
 
-        if business_object not in self._BUSINESS_OBJECTS:
-            raise Exception("%s not in list of QBO Business Objects." %  \
-                            business_object + " Please use one of the " + \
-                            "following: %s" % self._BUSINESS_OBJECTS)
+        if schema is None:
+            names = []
+        else:
+            names = [name for name in schema.names if name != "_extra"]
 
-        #eventually, we should be able to select more than just *,
-        #but chances are any further filtering is easier done with Python
-        #than in the query...
+        known = set(names)
 
-        query_string="SELECT * FROM %s" % business_object
+        names += sorted(set(k for row in rows for k in row) - known)
 
-        if query_tail == "" and not params == {}:
+        arrays = []
+        extras = [{} for row in rows]
 
-            #It's not entirely obvious what are valid properties for
-            #filtering, so we'll collect the working ones here and
-            #validate the properties before sending it
-            #datatypes are defined here:
-            #https://developer.intuit.com/docs/0025_quickbooksapi/
-            #    0050_data_services/020_key_concepts/0700_other_topics
+        for name in names:
+            values = self.typed(name, [row.get(name) for row in rows])
 
-            props = {
-                "TxnDate":"Date",
-                "MetaData.CreateTime":"DateTime",      #takes a Date though
-                "MetaData.LastUpdatedTime":"DateTime"  #ditto
-            }
+            if name not in known or \
+               pyarrow.types.is_null(schema.field(name).type):
+                #new, or nothing but nulls so far: let these values decide
+                arrays.append(self.to_array(values))
+                continue
 
-            p = params.keys()
+            column_type = schema.field(name).type
 
-            #only validating the property name for now, not the DataType
-            if p[0] not in props:
-                raise Exception("Unfamiliar property: %s" % p[0])
+            try:
+                arrays.append(self.to_array(values, column_type))
 
-            query_string+=" WHERE %s %s %s" % (p[0],
-                                               params[p[0]][0],
-                                               params[p[0]][1])
+            except (pyarrow.ArrowException, TypeError, ValueError):
+                arrays.append(pyarrow.array([None] * len(rows),
+                              type = column_type))
 
-            if len(p)>1:
-                for i in range(1,len(p)+1):
-                    if p[i] not in props:
-                        raise Exception("Unfamiliar property: %s" % p[i])
+                for extra, row in zip(extras, rows):
+                    if row.get(name) is not None:
+                        extra[name] = row[name]
 
-                    query_string+=" AND %s %s %s" % (p[i],
-                                                     params[p[i]][0],
-                                                     params[p[i]][1])
+        arrays.append(pyarrow.array([default_codec.encode(extra)
+                                     if extra else None for extra in extras],
+                                    type = pyarrow.string()))
 
-        elif not query_tail == "":
-            if not query_tail[0]==" ":
-                query_tail = " "+query_tail
-            query_string+=query_tail
+        return pyarrow.RecordBatch.from_arrays(arrays, names + ["_extra"])
 
-        #CAN ONE SESSION USE MULTIPLE COMPANIES?
-        #IF NOT, REMOVE THE COMPANY OPTIONALITY
-        url = self.base_url_v3 + "/company/%s/query" % self.company_id
+    def conform(self, batch, schema):
+        """
+        Casts batch to schema (the same table's schema from later on, or
+        earlier): columns batch doesn't have, or has only nulls in, take
+        schema's type, and values in columns that schema doesn't have (or
+        still has as null) go to _extra.
+        """
 
-        #print query_string
+        if batch.schema.equals(schema):
+            return batch
 
-        results = self.query_fetch_more(r_type="POST",
-                                        header_auth=True,
-                                        realm=self.company_id,
-                                        qb_object=business_object,
-                                        original_payload=query_string)
+        names = schema.names
 
-        return results
+        extras = [default_codec.decode(extra) if extra is not None else {}
+                  for extra in batch.column(
+                      batch.schema.names.index("_extra")).to_pylist()]
 
-    def get_objects(self,
-                    qbbo,
-                    requery=False,
-                    params = {},
-                    query_tail = ""):
-        """
-        Rather than have to look up the account that's associate with an
-        invoice item, for example, which requires another query, it might
-        be easier to just have a local dict for reference.
+        columns = dict((name, batch.column(i))
+                       for i, name in enumerate(batch.schema.names))
 
-        The same is true with linked transactions, so transactions can
-        also be cloned with this method
+        arrays = []
+
+        for name in names[:-1]:
+            column = columns.pop(name, None)
+            column_type = schema.field(name).type
+
+            if column is not None and column.type.equals(column_type):
+                arrays.append(column)
+                continue
+
+            if column is not None:
+                columns[name] = column
+
+            arrays.append(pyarrow.array([None] * len(extras),
+                                        type = column_type))
+
+        #whatever doesn't have a column to go in
+        for name, column in columns.items():
+            if name == "_extra" or pyarrow.types.is_null(column.type):
+                continue
+
+            for extra, value in zip(extras, column.to_pylist()):
+                if isinstance(value, datetime.date):
+                    value = value.isoformat()
+
+                if value is not None:
+                    extra[name] = value
+
+        arrays.append(pyarrow.array([default_codec.encode(extra)
+                                     if extra else None for extra in extras],
+                                    type = pyarrow.string()))
+
+        return pyarrow.RecordBatch.from_arrays(arrays, names)
+
+    def page_rows(self, page):
+        """(header rows, line rows) for a page of objects."""
+
+        headers = []
+        lines = []
+
+        for o in page:
+            header, line_rows = self.rows(o)
+            headers.append(header)
+            lines += line_rows
+
+        return headers, lines
+
+    def record_batches(self, qbbo, params = {}, query_tail = ""):
+        """
+        Yields (header batch, line batch) for each page of qbbo (the line
+        batch is None for pages without lines). Each batch's schema extends
+        the one before it, so conform them to the last one to combine them.
         """
 
-        #we'll call the attributes by the Business Object's name + 's',
-        #case-sensitive to what Intuit's documentation uses
+        schemas = {"header" : None, "line" : None}
 
-        if qbbo not in self._BUSINESS_OBJECTS:
+        for page in self.client.iter_objects(qbbo, params, query_tail,
+                                             pages = True):
+            headers, lines = self.page_rows(page)
 
-            raise Exception("%s is not a valid QBO Business Object." % qbbo)
+            header_batch = self.record_batch(headers, schemas["header"])
+            schemas["header"] = header_batch.schema
 
-        elif qbbo in self._NAME_LIST_OBJECTS and query_tail == "":
+            line_batch = None
 
-            #to avoid confusion from 'deleted' accounts later...
-            query_tail = "WHERE Active IN (true,false)"
+            if len(lines) > 0:
+                line_batch = self.record_batch(lines, schemas["line"])
+                schemas["line"] = line_batch.schema
 
-        attr_name = qbbo+"s"
+            yield header_batch, line_batch
 
-        #if we've already populated this list, only redo if told to
-        #because, say, we've created another Account or Item or something
-        #during the session
+    def to_tables(self, qbbo, params = {}, query_tail = ""):
+        """Returns (header table, line table) for qbbo, in memory."""
 
-        if not hasattr(self,attr_name) or requery:
+        headers = []
+        lines = []
 
-            if self.verbose:
-                print "Caching list of %ss." % qbbo
+        for header_batch, line_batch in self.record_batches(qbbo, params,
+                                                            query_tail):
+            headers.append(header_batch)
 
-            object_list = self.query_objects(qbbo, params, query_tail)
+            if line_batch is not None:
+                lines.append(line_batch)
 
-            #let's dictionarize it (keyed by Id), though, for easy lookup later
+        tables = []
 
-            object_dict = {}
+        for batches in [headers, lines]:
 
-            for o in object_list:
-                Id = o["Id"]
+            if len(batches) == 0:
+                tables.append(None)
+                continue
 
-                object_dict[Id] = o
+            #the last schema has every column (and type) that was learned
+            schema = batches[-1].schema
 
-            setattr(self, attr_name, object_dict)
+            tables.append(pyarrow.Table.from_batches(
+                [self.conform(batch, schema) for batch in batches]))
 
-        return getattr(self,attr_name)
+        header_table, line_table = tables
 
-    def object_dicts(self,
-                     qbbo_list = [],
-                     requery=False,
-                     params={},
-                     query_tail=""):
+        return header_table, line_table
+
+    def write_parquet(self, qbbo, directory, params = {}, query_tail = ""):
         """
-        returns a dict of dicts of ALL the Business Objects of
-        each of these types (filtering with params and query_tail)
+        Streams qbbo into <directory>/<qbbo>.parquet (and
+        <directory>/<qbbo>_lines.parquet if it has lines). A Parquet file's
+        schema is fixed once it's opened, so the flattened rows are spooled
+        to a temporary file (a page at a time) while the schema is worked
+        out over every page, then written out a batch at a time. Returns
+        the paths written.
         """
 
-        object_dicts = {}       #{qbbo:[object_list]}
+        schemas = {qbbo : None, qbbo + "_lines" : None}
+        spools = dict((name, tempfile.TemporaryFile()) for name in schemas)
+        paths = []
 
-        for qbbo in qbbo_list:
+        try:
+            for page in self.client.iter_objects(qbbo, params, query_tail,
+                                                 pages = True):
 
-            if qbbo == "TimeActivity":
-                #for whatever reason, this failed with some basic criteria, so
-                query_tail = ""
-            elif qbbo in self._NAME_LIST_OBJECTS and query_tail == "":
-                #just something to avoid confusion from 'deleted' accounts later
-                query_tail = "WHERE Active IN (true,false)"
+                for name, rows in zip([qbbo, qbbo + "_lines"],
+                                      self.page_rows(page)):
+                    if len(rows) == 0:
+                        continue
 
-            object_dicts[qbbo] = self.get_objects(qbbo,
-                                                  requery,
-                                                  params,
-                                                  query_tail)
+                    schemas[name] = self.record_batch(rows,
+                                                      schemas[name]).schema
 
-        return object_dicts
+                    spools[name].write(default_codec.encode(rows) + "\n")
 
-    def names(self,
-              requery=False,
-              params = {},
-              query_tail = "WHERE Active IN (true,false)"):
-        """
-        get a dict of every Name List Business Object (of every type)
+            for name in [qbbo, qbbo + "_lines"]:
+                if schemas[name] is None:
+                    continue
 
-        results are subject to the filter if applicable
+                path = "%s/%s.parquet" % (directory.rstrip("/"), name)
+                writer = pyarrow.parquet.ParquetWriter(path, schemas[name])
+                paths.append(path)
 
-        returned dict has two dimensions:
-        name = names[qbbo][Id]
+                try:
+                    spools[name].seek(0)
+
+                    for line in spools[name]:
+                        batch = self.record_batch(default_codec.decode(line),
+                                                  schemas[name])
+
+                        writer.write_table(pyarrow.Table.from_batches(
+                            [self.conform(batch, schemas[name])]))
+                finally:
+                    writer.close()
+
+        finally:
+            for spool in spools.values():
+                spool.close()
+
+        return paths
+
+    def export_names(self, directory):
+        """write_parquet for every Name List Business Object type."""
+
+        paths = []
+
+        for qbbo in self.client._NAME_LIST_OBJECTS:
+            paths += self.write_parquet(qbbo, directory,
+                                        query_tail = "WHERE Active IN " + \
+                                                     "(true,false)")
+
+        return paths
+
+    def export_transactions(self, directory):
+        """write_parquet for every Transaction Business Object type."""
+
+        paths = []
+
+        for qbbo in self.client._TRANSACTION_OBJECTS:
+            paths += self.write_parquet(qbbo, directory)
+
+        return paths
+
+class LedgerEngine():
+    """
+    Normalizes transaction objects into one general ledger line table (a
+    signed amount per account: debits positive, credits negative, with the
+    date, class and customer of each line), kept as NumPy arrays so that
+    balances, trial balances and rollups are vectorized group-bys.
+
+    How each type posts:
+        JournalEntry                  its lines, as debited/credited
+        Bill, Purchase, VendorCredit  lines debited, APAccountRef (Bill,
+                                      VendorCredit) or AccountRef (Purchase)
+                                      credited; reversed for VendorCredit
+                                      and credit-card credits
+        Invoice, SalesReceipt,        lines credited to the items' income
+        CreditMemo                    accounts, ARAccountRef (Invoice,
+                                      CreditMemo) or DepositToAccountRef
+                                      debited; reversed for CreditMemo
+        Payment                       DepositToAccountRef debited, AR credited
+        BillPayment                   AP debited, the bank/card credited
+    Estimates, PurchaseOrders and TimeActivities don't post. The header
+    side is posted at TotalAmt, and TxnTaxDetail.TotalTax goes to the sales
+    tax account alongside the lines. Anything left over (lines whose item
+    or account isn't known) is posted to the UNMAPPED placeholder, so every
+    transaction still balances.
+
+    Where QBO leaves the AR/AP (or deposit) account off, the company's own
+    account of that AccountSubType (from account_names, the get_objects
+    ("Account") dict) is used, so it's one trial balance row either way;
+    the ACCOUNTS_RECEIVABLE etc. placeholders only stand in for accounts
+    that aren't in account_names.
+
+    items (the get_objects("Item") dict) is needed to find the accounts
+    behind item-based lines.
+    """
+
+    ACCOUNTS_RECEIVABLE = "AccountsReceivable"
+    ACCOUNTS_PAYABLE = "AccountsPayable"
+    UNDEPOSITED_FUNDS = "UndepositedFunds"
+    SALES_TAX_PAYABLE = "SalesTaxPayable"
+    UNMAPPED = "Unmapped"
+
+    # AccountSubTypes of the accounts QBO posts to when a transaction
+    # doesn't name one
+    DEFAULT_SUB_TYPES = {
+        ACCOUNTS_RECEIVABLE : ["AccountsReceivable"],
+        ACCOUNTS_PAYABLE : ["AccountsPayable"],
+        UNDEPOSITED_FUNDS : ["UndepositedFunds"],
+        SALES_TAX_PAYABLE : ["GlobalTaxPayable", "SalesTaxPayable"],
+    }
+
+    EXPENSE_TYPES = {"Bill" : "APAccountRef", "Purchase" : "AccountRef",
+                     "VendorCredit" : "APAccountRef"}
+
+    SALES_TYPES = {"Invoice" : "ARAccountRef",
+                   "SalesReceipt" : "DepositToAccountRef",
+                   "CreditMemo" : "ARAccountRef"}
+
+    def __init__(self, items = {}, account_names = {}):
+
+        if numpy is None:
+            raise Exception("LedgerEngine needs numpy installed.")
+
+        self.items = items
+        self.account_names = account_names
+
+        #{placeholder: the company's account Id for it (or the placeholder)}
+        self.defaults = dict((placeholder, self.default_account(placeholder))
+                             for placeholder in self.DEFAULT_SUB_TYPES)
+
+        #{kind: {Id: code}} and {kind: [Id by code]} for account/class/customer
+        self.codes = {"account" : {}, "class" : {}, "customer" : {}}
+        self.ids = {"account" : [], "class" : [], "customer" : []}
+
+        self.pending = {"qbbo" : [], "txn" : [], "date" : [], "account" : [],
+                        "class" : [], "customer" : [], "amount" : []}
+
+        self.arrays = None
+
+    def default_account(self, placeholder):
+        """
+        The Id of the (first active) account with one of placeholder's
+        DEFAULT_SUB_TYPES, or the placeholder itself if there isn't one.
         """
 
-        return self.object_dicts(self._NAME_LIST_OBJECTS, requery,
-                                 params, query_tail)
+        matches = sorted(
+            (account.get("Active") is False, Id)
+            for Id, account in self.account_names.items()
+            if account.get("AccountSubType") in \
+               self.DEFAULT_SUB_TYPES[placeholder])
 
-    def transactions(self,
-                     requery=False,
-                     params = {},
-                     query_tail = ""):
+        return matches[0][1] if matches else placeholder
+
+    def code(self, kind, ref):
+        """Ref (or plain Id) -> small int, -1 for none."""
+
+        if ref is None:
+            return -1
+
+        Id = ref["value"] if isinstance(ref, dict) else ref
+
+        if Id not in self.codes[kind]:
+            self.codes[kind][Id] = len(self.ids[kind])
+            self.ids[kind].append(Id)
+
+        return self.codes[kind][Id]
+
+    def post(self, qbbo, txn, account, amount, class_ref = None,
+             customer_ref = None):
+        """Adds one ledger line (amount > 0 is a debit)."""
+
+        self.pending["qbbo"].append(qbbo)
+        self.pending["txn"].append(txn["Id"])
+        self.pending["date"].append(txn.get("TxnDate") or "NaT")
+        self.pending["account"].append(self.code("account", account))
+        self.pending["class"].append(self.code("class", class_ref))
+        self.pending["customer"].append(self.code("customer", customer_ref))
+        self.pending["amount"].append(float(amount))
+
+        self.arrays = None
+
+    def line_account(self, detail_type, detail):
+        """The account a transaction line posts to (None if it doesn't)."""
+
+        if detail_type in ["AccountBasedExpenseLineDetail",
+                           "JournalEntryLineDetail"]:
+            return detail.get("AccountRef")
+
+        if detail_type == "DiscountLineDetail":
+            return detail.get("DiscountAccountRef")
+
+        item = self.items.get(detail.get("ItemRef", {}).get("value"))
+
+        if item is None:
+            return None
+
+        if detail_type == "ItemBasedExpenseLineDetail":
+            #inventory items also have an ExpenseAccountRef (cost of goods
+            #sold), but buying them adds to the inventory asset account
+            return item.get("AssetAccountRef") or \
+                   item.get("ExpenseAccountRef")
+
+        if detail_type == "SalesItemLineDetail":
+            return item.get("IncomeAccountRef")
+
+        return None
+
+    @staticmethod
+    def line_customer(detail):
+
+        entity = detail.get("Entity")
+
+        if isinstance(entity, dict) and entity.get("Type") == "Customer":
+            return entity.get("EntityRef")
+
+        return detail.get("CustomerRef")
+
+    def add_transaction(self, qbbo, txn):
+        """Posts one transaction object (skipping types that don't post)."""
+
+        if isinstance(txn, CompactEntity):
+            txn = txn.to_dict()
+
+        if qbbo == "JournalEntry":
+
+            for line in txn.get("Line", []):
+                detail = line.get("JournalEntryLineDetail")
+
+                if detail is None or "AccountRef" not in detail:
+                    continue
+
+                sign = 1 if detail.get("PostingType") == "Debit" else -1
+
+                self.post(qbbo, txn, detail["AccountRef"],
+                          sign * line.get("Amount", 0),
+                          detail.get("ClassRef"), self.line_customer(detail))
+
+        elif qbbo in self.EXPENSE_TYPES or qbbo in self.SALES_TYPES:
+
+            if qbbo in self.EXPENSE_TYPES:
+                #lines are debits, unless it's a credit of some sort
+                sign = 1
+                header_account = txn.get(self.EXPENSE_TYPES[qbbo]) or \
+                                 self.defaults[self.ACCOUNTS_PAYABLE]
+
+                if qbbo == "VendorCredit" or txn.get("Credit") is True:
+                    sign = -1
+
+            else:
+                #lines are credits, unless it's a credit memo
+                sign = -1
+                header_account = txn.get(self.SALES_TYPES[qbbo]) or \
+                                 self.defaults[self.ACCOUNTS_RECEIVABLE]
+
+                if qbbo == "CreditMemo":
+                    sign = 1
+
+            header_customer = txn.get("CustomerRef")
+            total = 0.0
+
+            for line in txn.get("Line", []):
+                detail_type = line.get("DetailType")
+                detail = line.get(detail_type)
+
+                if not isinstance(detail, dict):
+                    continue
+
+                account = self.line_account(detail_type, detail)
+
+                if account is None:
+                    continue
+
+                amount = sign * line.get("Amount", 0)
+
+                #discounts go the other way to the lines they discount
+                if detail_type == "DiscountLineDetail":
+                    amount = -amount
+
+                self.post(qbbo, txn, account, amount, detail.get("ClassRef"),
+                          self.line_customer(detail) or header_customer)
+
+                total += amount
+
+            tax = sign * float(txn.get("TxnTaxDetail", {}).get("TotalTax")
+                               or 0)
+
+            if tax != 0:
+                self.post(qbbo, txn, self.defaults[self.SALES_TAX_PAYABLE],
+                          tax, txn.get("ClassRef"), header_customer)
+
+                total += tax
+
+            if "TotalAmt" in txn:
+                header = sign * float(txn["TotalAmt"])
+            else:
+                header = total
+
+            #lines we couldn't place, so the transaction still balances
+            if abs(header - total) >= 0.005:
+                self.post(qbbo, txn, self.UNMAPPED, header - total,
+                          txn.get("ClassRef"), header_customer)
+
+            if header != 0:
+                self.post(qbbo, txn, header_account, -header,
+                          txn.get("ClassRef"), header_customer)
+
+        elif qbbo == "Payment":
+
+            amount = txn.get("TotalAmt", 0)
+
+            self.post(qbbo, txn, txn.get("DepositToAccountRef") or \
+                      self.defaults[self.UNDEPOSITED_FUNDS], amount, None,
+                      txn.get("CustomerRef"))
+            self.post(qbbo, txn, txn.get("ARAccountRef") or \
+                      self.defaults[self.ACCOUNTS_RECEIVABLE], -amount, None,
+                      txn.get("CustomerRef"))
+
+        elif qbbo == "BillPayment":
+
+            amount = txn.get("TotalAmt", 0)
+
+            paid_from = txn.get("CheckPayment", {}).get("BankAccountRef") or \
+                        txn.get("CreditCardPayment", {}).get("CCAccountRef")
+
+            if paid_from is None:
+                return
+
+            self.post(qbbo, txn, txn.get("APAccountRef") or \
+                      self.defaults[self.ACCOUNTS_PAYABLE], amount)
+            self.post(qbbo, txn, paid_from, -amount)
+
+    def add_transactions(self, qbbo, transactions):
+        for txn in transactions:
+            self.add_transaction(qbbo, txn)
+
+    def freeze(self):
+        """Turns the posted lines into NumPy arrays (done lazily)."""
+
+        if self.arrays is None:
+            p = self.pending
+
+            self.arrays = {
+                "qbbo" : numpy.array(p["qbbo"], dtype=object),
+                "txn" : numpy.array(p["txn"], dtype=object),
+                "date" : numpy.array(p["date"], dtype="datetime64[D]"),
+                "account" : numpy.array(p["account"], dtype=numpy.int32),
+                "class" : numpy.array(p["class"], dtype=numpy.int32),
+                "customer" : numpy.array(p["customer"], dtype=numpy.int32),
+                "amount" : numpy.array(p["amount"], dtype=numpy.float64)
+            }
+
+        return self.arrays
+
+    def mask(self, start = None, end = None):
+        """Which lines fall between start and end (inclusive dates)."""
+
+        a = self.freeze()
+        keep = numpy.ones(len(a["amount"]), dtype=bool)
+
+        if start is not None:
+            keep &= a["date"] >= numpy.datetime64(start, "D")
+
+        if end is not None:
+            keep &= a["date"] <= numpy.datetime64(end, "D")
+
+        return keep
+
+    def account_balances(self, start = None, end = None):
+        """{account Id: balance} (debits positive) over the date range."""
+
+        a = self.freeze()
+        keep = self.mask(start, end)
+
+        sums = numpy.bincount(a["account"][keep],
+                              weights = a["amount"][keep],
+                              minlength = len(self.ids["account"]))
+
+        return dict((self.ids["account"][code], sums[code])
+                    for code in numpy.nonzero(sums)[0])
+
+    def trial_balance(self, as_of = None):
+        """
+        A list of {"account", "name", "debit", "credit"} rows (each account's
+        balance in the column it falls on), ordered by account Id, plus the
+        totals, as (rows, total_debits, total_credits).
         """
-        get a dict of every Transaction Business Object (of every type)
 
-        results are subject to the filter if applicable
+        a = self.freeze()
+        keep = self.mask(None, as_of)
 
-        returned dict has two dimensions:
-        transaction = transactions[qbbo][Id]
+        sums = numpy.bincount(a["account"][keep],
+                              weights = a["amount"][keep],
+                              minlength = len(self.ids["account"]))
+
+        debits = numpy.where(sums > 0, sums, 0.0)
+        credits = numpy.where(sums < 0, -sums, 0.0)
+
+        rows = []
+
+        for code in numpy.nonzero(numpy.round(sums, 2))[0]:
+            Id = self.ids["account"][code]
+
+            rows.append({"account" : Id,
+                         "name" : self.account_names.get(Id, {}).get("Name"),
+                         "debit" : debits[code],
+                         "credit" : credits[code]})
+
+        rows.sort(key = lambda row: row["account"])
+
+        return rows, debits.sum(), credits.sum()
+
+    def rollup(self, by = "class", start = None, end = None,
+               account_ids = None):
+        """
+        {(class or customer Id, account Id): balance}, "by" being "class" or
+        "customer" (lines without one are keyed by None). account_ids
+        limits it to those accounts.
         """
 
-        return self.object_dicts(self._TRANSACTION_OBJECTS, requery,
-                                        params, query_tail)
+        a = self.freeze()
+        keep = self.mask(start, end)
+
+        if account_ids is not None:
+            wanted = numpy.array([self.codes["account"].get(Id, -2)
+                                  for Id in account_ids], dtype=numpy.int32)
+            keep &= numpy.in1d(a["account"], wanted)
+
+        n_accounts = max(len(self.ids["account"]), 1)
+
+        #shift by one so "none" (-1) gets a bucket of its own
+        keys = (a[by][keep].astype(numpy.int64) + 1) * n_accounts + \
+               a["account"][keep]
+
+        sums = numpy.bincount(keys, weights = a["amount"][keep],
+                              minlength = (len(self.ids[by]) + 1) * n_accounts)
+
+        rollup = {}
+
+        for key in numpy.nonzero(sums)[0]:
+            group, account = divmod(int(key), n_accounts)
+
+            group_id = self.ids[by][group - 1] if group > 0 else None
+
+            rollup[(group_id, self.ids["account"][account])] = sums[key]
 
+        return rollup